@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Runs the pyfilesystem layer against an emulated fsp-srv, reporting round trips and time per operation
+
+import os
+import time
+import argparse
+import tempfile
+
+import nxipc
+from nxipc.emulator import Emulator, EmulatedFspSrv, EmulatedSetSys
+
+def make_tree(root, dirs, files, file_size):
+    for i in range(dirs):
+        os.makedirs(os.path.join(root, "bench", f"dir{i:03}"))
+
+        for j in range(files):
+            with open(os.path.join(root, "bench", f"dir{i:03}", f"file{j:03}.bin"), "wb") as f:
+                f.write(os.urandom(file_size))
+
+    with open(os.path.join(root, "big.bin"), "wb") as f:
+        f.write(os.urandom(0x1000000))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency",   type=float, default=0.0005, help="seconds per round trip")
+    parser.add_argument("--bandwidth", type=float, default=40e6,   help="bytes per second")
+    parser.add_argument("--dirs",      type=int,   default=8)
+    parser.add_argument("--files",     type=int,   default=32)
+    parser.add_argument("--file-size", type=int,   default=0x1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.dirs, args.files, args.file_size)
+
+        emu = Emulator({
+            b"fsp-srv": lambda e: EmulatedFspSrv(e, root),
+            b"set:sys": EmulatedSetSys,
+        }, round_trip_latency=args.latency, bandwidth=args.bandwidth).start()
+
+        h = emu.handler()
+        h.load_firmware_version()
+
+        sd = nxipc.services.FspSrv(h).open_sd_card_fs()
+
+        dirs = [f"/bench/dir{i:03}" for i in range(args.dirs)]
+        names = [f"{d}/file{j:03}.bin" for d in dirs for j in range(args.files)]
+
+        ops = [
+            ("listdir",       lambda: [sd.listdir(d) for d in dirs]),
+            ("listdir_array", lambda: [sd.listdir_array(d) for d in dirs]),
+            ("getinfo",       lambda: [sd.getinfo(x, ["details"]) for x in names]),
+            ("walk",          lambda: list(sd.walk.files("/bench"))),
+            ("read small",    lambda: [sd.readbytes(x) for x in names]),
+            ("read big",      lambda: sd.readbytes("/big.bin")),
+            ("write big",     lambda: sd.writebytes("/big2.bin", bytes(0x1000000))),
+            ("download_many", lambda: sd.download_many(names)),
+        ]
+
+        print(f"{'operation':<16}{'round trips':>12}{'bytes':>12}{'seconds':>10}{'MB/s':>8}")
+
+        for name, op in ops:
+            emu.reset_counters()
+
+            start = time.perf_counter()
+            op()
+            elapsed = time.perf_counter() - start
+
+            stats = emu.stats
+            size = stats["bytes_out"] + stats["bytes_in"]
+
+            print(f"{name:<16}{stats['commands']:>12}{size:>12}{elapsed:>10.3f}{size / elapsed / 1e6:>8.1f}")
+
+        sd.close()
+        h.execute(nxipc.commands.Exit)
+        emu.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+# Fails if importing nxipc pulls in dependencies it shouldn't need yet, or takes too long
+
+import re
+import sys
+import subprocess
+
+# Only imported once the code that needs them is used
+deferred = ("usb", "fs", "PIL", "numpy", "audioread")
+
+budget_us = 50000
+
+def import_times(statement):
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                          capture_output=True, text=True, check=True)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s*(\d+) \|\s*(\d+) \|( *)(\S+)", line)
+        if match is not None and len(match.group(3)) == 1:
+            # Only top level imports, which include everything they imported
+            times[match.group(4)] = int(match.group(2))
+
+    return proc.stderr, times
+
+def main():
+    output, times = import_times("import nxipc")
+
+    failed = False
+
+    imported = [name for name in deferred if re.search(rf"\| +{re.escape(name)}(\.|$)", output, re.MULTILINE)]
+    if len(imported) > 0:
+        print(f"Imported eagerly: {', '.join(imported)}")
+        failed = True
+
+    total = times.get("nxipc", 0)
+    print(f"import nxipc: {total / 1000:.1f} ms (budget {budget_us / 1000:.1f} ms)")
+
+    if total > budget_us:
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
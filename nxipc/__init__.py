@@ -1,39 +1,59 @@
-import usb.core
-import usb.util
-import io
+import os
+import abc
+import time
+import array
 import enum
 import ctypes
+import importlib
 
+from . import util, cache, services
+from .types import Priority, ResultException
+from .commands import Nop, Ping, GetDeviceInfo
 from .services import Service, SubService
 
-class UsbCommandHandler:
-    def __init__(self, idVendor=0x057e, idProduct=0x3000, timeout=3000, max_rw=0xe00):
-        self.dev = usb.core.find(idVendor=idVendor, idProduct=idProduct)
-        if self.dev is None:
-            raise ValueError("Device not found")
+# Submodules with heavy dependencies of their own, imported on first use like the services
+lazy_modules = ("pcm", "mux", "sync", "transfer", "emulator")
 
-        self.dev.set_configuration()
-        intf = self.dev.get_active_configuration()[(0,0)]
-        self.ep = (usb.util.find_descriptor(intf,
-                      custom_match=lambda e:usb.util.endpoint_direction(e.bEndpointAddress)==usb.util.ENDPOINT_OUT),
-                   usb.util.find_descriptor(intf,
-                      custom_match=lambda e:usb.util.endpoint_direction(e.bEndpointAddress)==usb.util.ENDPOINT_IN))
+def __getattr__(name):
+    if name in services.lazy:
+        return getattr(services, name)
 
-        self.timeout = timeout
-        self.max_rw = max_rw
+    if name in lazy_modules:
+        return importlib.import_module(f".{name}", __name__)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(set(globals()) | set(services.lazy) | set(lazy_modules))
+
+class CommandHandler(abc.ABC):
+    # Bulk transfers are split into commands of at most this size, so
+    # higher priority commands never wait on more than one of them
+    frame_size = 0x40000
+
+    # Set while the handler's link is split into channels
+    mux = None
+
+    # What the console said it supports, see GetDeviceInfo. None until it's been asked.
+    capabilities = None
+
+    def __init__(self):
+        self.lock = util.PriorityLock()
 
         self.closed = False
 
+        self.created = time.perf_counter()
+        self.first_command_time = None
+
+    # The transport, which is all a handler needs to provide. Writes take
+    # anything with the buffer protocol, and reads fill buf completely.
+    @abc.abstractmethod
     def write(self, *args):
-        write_f = b"".join(bytes(x) for x in args if x is not None)
-        size = len(write_f)
-        if size == 0:
-            return
+        pass
 
-        write_f = io.BytesIO(write_f)
-        while write_f.tell() < size:
-            to_write = min(size - write_f.tell(), self.max_rw)
-            self.ep[0].write(write_f.read(to_write), timeout=self.timeout)
+    @abc.abstractmethod
+    def readinto(self, buf):
+        pass
 
     def read(self, *args):
         if len(args) == 1 and isinstance(args[0], int):
@@ -44,22 +64,20 @@ class UsbCommandHandler:
         if size == 0:
             return
 
-        read_f = io.BytesIO()
-        while read_f.tell() < size:
-            to_read = min(size - read_f.tell(), self.max_rw)
-            read_f.write(self.ep[1].read(to_read, timeout=self.timeout).tobytes())
-
-        read_f.seek(0)
+        buf = bytearray(size)
+        self.readinto(buf)
 
         if isinstance(args[0], int):
-            return read_f.read(args[0])
+            return bytes(buf)
 
         ret = []
+        offset = 0
         for arg in args:
             if arg is None:
                 continue
 
-            ret.append(arg.from_buffer(bytearray(read_f.read(ctypes.sizeof(arg)))))
+            ret.append(arg.from_buffer(buf, offset))
+            offset += ctypes.sizeof(arg)
 
         if len(ret) == 1:
             return ret[0]
@@ -69,6 +87,203 @@ class UsbCommandHandler:
 
         return ret
 
-    def execute(self, cmd, *args, **kwargs):
-        if not self.closed:
-            return cmd.execute(self, *args, **kwargs)
\ No newline at end of file
+    def execute(self, cmd, *args, priority=Priority.Normal, **kwargs):
+        if self.mux is not None:
+            raise RuntimeError("Handler is split into channels, use those instead")
+
+        with self.lock(priority):
+            if not self.closed:
+                ret = cmd.execute(self, *args, **kwargs)
+
+                if self.first_command_time is None:
+                    self.first_command_time = time.perf_counter() - self.created
+
+                return ret
+
+class UsbCommandHandler(CommandHandler):
+    serial = None
+
+    def __init__(self, idVendor=0x057e, idProduct=0x3000, timeout=3000, max_rw=0xe00, device_cache=None):
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+
+        self.timeout = timeout
+        self.max_rw = max_rw
+
+        self.device_cache = device_cache
+
+        super().__init__()
+
+        self.connect()
+        self.connect_time = time.perf_counter() - self.created
+
+    @property
+    def startup_stats(self):
+        return {
+            "connect":       self.connect_time,
+            "first_command": self.first_command_time,
+        }
+
+    @property
+    def device_key(self):
+        if self.serial is None:
+            return None
+
+        return f"{self.idVendor:04x}:{self.idProduct:04x}:{self.serial}"
+
+    def connect(self):
+        # pyusb is only needed once there's a device to talk to
+        import usb.core, usb.util
+
+        self.dev = usb.core.find(idVendor=self.idVendor, idProduct=self.idProduct)
+        if self.dev is None:
+            raise ValueError("Device not found")
+
+        self.dev.set_configuration()
+
+        try:
+            if self.dev.iSerialNumber != 0:
+                self.serial = usb.util.get_string(self.dev, self.dev.iSerialNumber)
+        except (usb.core.USBError, ValueError):
+            self.serial = None
+        intf = self.dev.get_active_configuration()[(0,0)]
+        self.ep = (usb.util.find_descriptor(intf,
+                      custom_match=lambda e:usb.util.endpoint_direction(e.bEndpointAddress)==usb.util.ENDPOINT_OUT),
+                   usb.util.find_descriptor(intf,
+                      custom_match=lambda e:usb.util.endpoint_direction(e.bEndpointAddress)==usb.util.ENDPOINT_IN))
+
+    def device_info(self):
+        try:
+            return self.execute(GetDeviceInfo, priority=Priority.High)
+        except ResultException:
+            # From before the console could tell us
+            return None
+
+    def load_firmware_version(self):
+        # Checking against the console's version is a single small command, instead of
+        # opening set:sys and pulling the whole FirmwareVersion through it
+        info = self.device_info()
+
+        entry = None
+        if info is not None:
+            self.capabilities = info.capabilities
+
+            Service.version = info.version
+
+            if self.device_cache is not None and self.device_key is not None:
+                entry = self.device_cache.get(self.device_key)
+
+        if entry is not None and entry.get("hos_version") == info.hos_version:
+            version = services.SetSys.FirmwareVersion.from_buffer_copy(bytes.fromhex(entry["firmware_version"]))
+        else:
+            with services.SetSys(self) as setsys:
+                version = setsys.get_version()
+
+            if info is not None and self.device_cache is not None and self.device_key is not None:
+                self.device_cache.update(self.device_key,
+                    hos_version      = info.hos_version,
+                    capabilities     = info.capabilities,
+                    firmware_version = bytes(version).hex(),
+                )
+
+        Service.version = version.hos_version
+
+        return version
+
+    def reconnect(self, max_pending=0x100000):
+        import usb.core, usb.util
+
+        with self.lock(Priority.High):
+            if self.dev is not None:
+                try:
+                    usb.util.dispose_resources(self.dev)
+                except usb.core.USBError:
+                    pass
+
+            self.connect()
+            self.resync(max_pending)
+
+    def drain(self, timeout=100):
+        import usb.core
+
+        drained = 0
+
+        while True:
+            try:
+                drained += len(self.ep[1].read(self.max_rw, timeout=timeout))
+            except usb.core.USBTimeoutError:
+                return drained
+
+    def wait_for(self, pattern, timeout=100):
+        import usb.core
+
+        # Anything before the pattern is left over from whatever was interrupted
+        received = b""
+        while True:
+            try:
+                received += bytes(self.ep[1].read(self.max_rw, timeout=timeout))
+            except usb.core.USBTimeoutError:
+                return False
+
+            if pattern in received:
+                return True
+
+            received = received[-(len(pattern) - 1):]
+
+    def resync(self, max_pending=0x100000, timeout=100):
+        # The console may be in the middle of reading a payload or writing a response,
+        # so feed it filler until one of our pings comes back. Each transfer completes
+        # one read on the console, and anything that ends up read as a command is a Nop.
+        import usb.core
+
+        with self.lock(Priority.High):
+            self.drain(timeout)
+
+            filler = bytes([Nop.id]) * self.max_rw
+            sent = 0
+
+            while True:
+                nonce = int.from_bytes(os.urandom(8), "little") & ~0xff | Nop.id
+
+                try:
+                    Ping.send(self, nonce)
+                except usb.core.USBTimeoutError:
+                    # The console is blocked on sending us something
+                    self.drain(timeout)
+                else:
+                    if self.wait_for(Ping.pong(nonce), timeout):
+                        return
+
+                if sent >= max_pending:
+                    raise IOError("Unable to resynchronize with the console")
+
+                try:
+                    self.ep[0].write(filler, timeout=self.timeout)
+                except usb.core.USBTimeoutError:
+                    self.drain(timeout)
+
+                sent += len(filler)
+
+    def write(self, *args):
+        view = util.byte_view(*args)
+
+        # pyusb takes arrays as they are, so each transfer is only copied once
+        for start in range(0, view.nbytes, self.max_rw):
+            transfer = array.array("B")
+            transfer.frombytes(view[start:start + self.max_rw])
+
+            self.ep[0].write(transfer, timeout=self.timeout)
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast("B")
+        size = view.nbytes
+
+        pos = 0
+        while pos < size:
+            to_read = min(size - pos, self.max_rw)
+            data = self.ep[1].read(to_read, timeout=self.timeout)
+
+            view[pos:pos + len(data)] = data
+            pos += len(data)
+
+        return size
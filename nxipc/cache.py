@@ -0,0 +1,530 @@
+import os
+import json
+import time
+import ctypes
+import weakref
+import threading
+import functools
+import collections
+
+def normalize_path(path):
+    # So every spelling of a path ends up at the same entry. Only the
+    # filesystem caches need this, and they come with pyfilesystem anyway.
+    import fs.path
+
+    return fs.path.abspath(fs.path.normpath(path))
+
+class BlockCache:
+    def __init__(self, budget=0x1000000, block_size=0x10000):
+        self.budget = budget
+        self.block_size = block_size
+
+        self.blocks = collections.OrderedDict()
+        self.paths = {}
+        self.used = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {
+            "hits":      self.hits,
+            "misses":    self.misses,
+            "evictions": self.evictions,
+            "blocks":    len(self.blocks),
+            "used":      self.used,
+            "budget":    self.budget,
+        }
+
+    @staticmethod
+    def key(fs, path):
+        # A weak reference to the filesystem, so a new one that ends up at the same
+        # address doesn't see the old one's blocks, and without keeping it alive
+        return (weakref.ref(fs), normalize_path(path))
+
+    def get(self, fs, path, index):
+        key = self.key(fs, path) + (index,)
+
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+
+                return None
+
+            self.blocks.move_to_end(key)
+            self.hits += 1
+
+            return block
+
+    def put(self, fs, path, index, block):
+        if len(block) > self.budget:
+            return
+
+        key = self.key(fs, path) + (index,)
+
+        with self.lock:
+            old = self.blocks.pop(key, None)
+            if old is not None:
+                self.used -= len(old)
+
+            self.blocks[key] = block
+            self.used += len(block)
+
+            self.paths.setdefault(key[:2], set()).add(index)
+
+            while self.used > self.budget:
+                old_key, old = self.blocks.popitem(last=False)
+                self.used -= len(old)
+
+                indices = self.paths[old_key[:2]]
+                indices.discard(old_key[2])
+                if len(indices) == 0:
+                    del self.paths[old_key[:2]]
+
+                self.evictions += 1
+
+    def invalidate(self, fs, path=None):
+        with self.lock:
+            if path is None:
+                owner = weakref.ref(fs)
+                paths = [x for x in self.paths if x[0] == owner]
+            else:
+                paths = [self.key(fs, path)]
+
+            for p in paths:
+                for index in self.paths.pop(p, ()):
+                    self.used -= len(self.blocks.pop(p + (index,)))
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.paths.clear()
+            self.used = 0
+
+class MetadataCache:
+    # A ttl of None never expires entries, for filesystems that can't change under us
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+
+        self.entries = {}
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {
+            "hits":    self.hits,
+            "misses":  self.misses,
+            "entries": len(self.entries),
+        }
+
+    def get(self, path, key):
+        path = normalize_path(path)
+
+        with self.lock:
+            value = self.entries.get(path, {}).get(key)
+
+            if value is None or (self.ttl is not None and time.monotonic() - value[1] > self.ttl):
+                self.misses += 1
+
+                return None
+
+            self.hits += 1
+
+            return value[0]
+
+    def update(self, path, **values):
+        path = normalize_path(path)
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.setdefault(path, {})
+
+            for key, value in values.items():
+                entry[key] = (value, now)
+
+    def invalidate(self, path=None, recursive=False):
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+
+                return
+
+            path = normalize_path(path)
+            self.entries.pop(path, None)
+
+            if recursive:
+                prefix = path.rstrip("/") + "/"
+
+                for p in [x for x in self.entries if x.startswith(prefix)]:
+                    del self.entries[p]
+
+    def clear(self):
+        self.invalidate()
+
+class HandleCache:
+    # What a checked out handle was acquired as, and whether it can still go back in the pool
+    class Ticket:
+        def __init__(self, key):
+            self.key = key
+            self.valid = True
+
+    # Sessions are a limited resource on the console, so stay well below the limit
+    def __init__(self, max_handles=16):
+        self.max_handles = max_handles
+
+        self.idle = collections.OrderedDict()
+        self.tickets = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    @property
+    def outstanding(self):
+        return len(self.tickets)
+
+    @property
+    def stats(self):
+        return {
+            "hits":        self.hits,
+            "misses":      self.misses,
+            "evictions":   self.evictions,
+            "idle":        len(self.idle),
+            "outstanding": self.outstanding,
+        }
+
+    def evict(self, room=0):
+        to_close = []
+
+        with self.lock:
+            while len(self.idle) > 0 and len(self.idle) + self.outstanding + room > self.max_handles:
+                to_close.append(self.idle.popitem(last=False)[1])
+                self.evictions += 1
+
+        for handle in to_close:
+            handle.close()
+
+    def acquire(self, key):
+        # Keyed by path and mode
+        key = (normalize_path(key[0]),) + tuple(key[1:])
+        ticket = self.Ticket(key)
+
+        with self.lock:
+            self.tickets.add(ticket)
+
+            handle = self.idle.pop(key, None)
+            if handle is not None:
+                self.hits += 1
+
+                return handle, ticket
+
+            self.misses += 1
+
+        # Make room for the handle the caller is about to open
+        self.evict()
+
+        return None, ticket
+
+    def release(self, ticket, handle):
+        with self.lock:
+            self.tickets.discard(ticket)
+
+            # Anything invalidated while the handle was out can't be trusted
+            keep = ticket.valid and ticket.key not in self.idle
+            if keep:
+                self.idle[ticket.key] = handle
+
+        self.evict()
+
+        return keep
+
+    def has_path(self, path):
+        path = normalize_path(path)
+
+        with self.lock:
+            return any(key[0] == path for key in self.idle)
+
+    def discard(self, ticket):
+        with self.lock:
+            self.tickets.discard(ticket)
+
+    @staticmethod
+    def matches(key, path, recursive):
+        return path is None or key[0] == path or (recursive and key[0].startswith(path.rstrip("/") + "/"))
+
+    def invalidate(self, path=None, recursive=False):
+        to_close = []
+
+        if path is not None:
+            path = normalize_path(path)
+
+        with self.lock:
+            # Only handles to the affected paths are kept from going back in the pool
+            for ticket in self.tickets:
+                if self.matches(ticket.key, path, recursive):
+                    ticket.valid = False
+
+            for key in list(self.idle):
+                if self.matches(key, path, recursive):
+                    to_close.append(self.idle.pop(key))
+
+        for handle in to_close:
+            handle.close()
+
+    def clear(self):
+        self.invalidate()
+
+class ImageCache:
+    # Decoded images are kept in memory, and with a directory their data is kept on disk
+    # between runs. Each has a version, and anything from another version is never returned.
+    def __init__(self, directory=None, max_images=32):
+        self.directory = directory
+        self.max_images = max_images
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+        self.images = collections.OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {
+            "hits":      self.hits,
+            "disk_hits": self.disk_hits,
+            "misses":    self.misses,
+            "evictions": self.evictions,
+            "images":    len(self.images),
+        }
+
+    def path(self, name, version):
+        return os.path.join(self.directory, f"{name}-{version}")
+
+    def store(self, name, version, image):
+        with self.lock:
+            self.images[name] = (version, image)
+            self.images.move_to_end(name)
+
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, name, version, decode):
+        with self.lock:
+            entry = self.images.get(name)
+            if entry is not None and entry[0] == version:
+                self.images.move_to_end(name)
+                self.hits += 1
+
+                return entry[1]
+
+        if self.directory is not None and os.path.exists(self.path(name, version)):
+            with open(self.path(name, version), "rb") as f:
+                image = decode(f.read())
+
+            self.disk_hits += 1
+            self.store(name, version, image)
+
+            return image
+
+        self.misses += 1
+
+        return None
+
+    def put(self, name, version, data, decode):
+        image = decode(data)
+
+        if self.directory is not None:
+            self.remove_files(name)
+
+            tmp_path = self.path(name, version) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+            os.replace(tmp_path, self.path(name, version))
+
+        self.store(name, version, image)
+
+        return image
+
+    def remove_files(self, name=None):
+        # Only touch what was written here, in case the directory is shared
+        for entry in os.listdir(self.directory):
+            parts = entry.rsplit("-", 1)
+            if len(parts) != 2 or not parts[1].isdigit():
+                continue
+
+            if name is None or parts[0] == name:
+                os.remove(os.path.join(self.directory, entry))
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.images.clear()
+            else:
+                self.images.pop(name, None)
+
+        if self.directory is not None:
+            self.remove_files(name)
+
+    def clear(self):
+        self.invalidate()
+
+class DeviceCache:
+    # What's known about each console between runs, keyed by whatever identifies it
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser("~"), ".cache", "nxipc", "devices.json")
+
+        self.path = path
+
+        self.entries = {}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+
+        os.replace(tmp_path, self.path)
+
+    def update(self, key, **values):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(values)
+            self.save()
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+            self.save()
+
+    def clear(self):
+        self.invalidate()
+
+class Memoized:
+    # Turns every memoized method back into a plain call, so tests can see each command
+    enabled = True
+
+    registry = []
+
+    class Bound:
+        def __init__(self, memoized, instance):
+            self.memoized = memoized
+            self.instance = instance
+
+        def __call__(self, *args, **kwargs):
+            return self.memoized.call(self.instance, args, kwargs)
+
+        def invalidate(self):
+            self.memoized.invalidate(self.instance)
+
+    # Values last as long as the object they came from, or ttl seconds, or until invalidated
+    def __init__(self, func, ttl=None):
+        functools.update_wrapper(self, func)
+
+        self.func = func
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+        Memoized.registry.append(self)
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+
+        return self.Bound(self, instance)
+
+    def entries(self, instance):
+        return instance.__dict__.setdefault("memoized", {}).setdefault(self.func.__qualname__, {})
+
+    def call(self, instance, args, kwargs):
+        if not self.enabled:
+            return self.func(instance, *args, **kwargs)
+
+        key = (args, tuple(sorted(kwargs.items())))
+        entries = self.entries(instance)
+
+        with self.lock:
+            entry = entries.get(key)
+
+            if entry is not None and (self.ttl is None or time.monotonic() - entry[1] <= self.ttl):
+                self.hits += 1
+
+                return self.copy(entry[0])
+
+            self.misses += 1
+
+        value = self.func(instance, *args, **kwargs)
+
+        with self.lock:
+            entries[key] = (value, time.monotonic())
+
+        return self.copy(value)
+
+    @staticmethod
+    def copy(value):
+        # So callers can't change what's cached
+        if isinstance(value, list):
+            return [Memoized.copy(x) for x in value]
+
+        if isinstance(value, (ctypes.Structure, ctypes.Union, ctypes.Array)):
+            return type(value).from_buffer_copy(value)
+
+        return value
+
+    def invalidate(self, instance):
+        with self.lock:
+            self.entries(instance).clear()
+
+    @property
+    def stats(self):
+        return {
+            "hits":   self.hits,
+            "misses": self.misses,
+        }
+
+def memoize(ttl=None):
+    return lambda func: Memoized(func, ttl)
+
+def memoized_stats():
+    return {x.func.__qualname__: x.stats for x in Memoized.registry}
+
+def invalidate_memoized(instance):
+    instance.__dict__.pop("memoized", None)
@@ -109,10 +109,8 @@ class Write(Command):
 
     @classmethod
     def execute(cls, h, ptr, to_write):
-        if isinstance(to_write, (bytes, bytearray)):
-            size = len(to_write)
-        else:
-            size = sizeof(to_write)
+        # Anything with the buffer protocol, like ctypes objects or NumPy arrays
+        size = memoryview(to_write).nbytes
 
         h.write(c_uint8(cls.id))
         h.write(cls.Info(ptr, size))
@@ -158,10 +156,14 @@ class DispatchToService(Command):
         ]
 
     class Buffer(LittleEndianStructure):
+        Inline  = 0
+        Pointer = 1
+        Compact = 2
+
         _fields_ = [
-            ("size",       c_uint64),
-            ("attr",       c_uint32),
-            ("is_pointer", c_bool)
+            ("size", c_uint64),
+            ("attr", c_uint32),
+            ("kind", c_uint8)
         ]
 
     @classmethod
@@ -187,6 +189,9 @@ class DispatchToService(Command):
 
         h.write(in_data)
 
+        # Consoles from before compact buffers would misparse them
+        compact_allowed = h.capabilities is not None and (h.capabilities & GetDeviceInfo.CompactBuffer) != 0
+
         buffer_attrs = []
         for first, attr in buffers:
             if isinstance(attr, enum.Enum):
@@ -204,18 +209,44 @@ class DispatchToService(Command):
             elif isinstance(first, (bytes, bytearray)):
                 real_size = len(first)
                 attr |= SfBufferAttr.In.value
+            elif isinstance(first, memoryview):
+                real_size = first.nbytes
+
+                # Views are read into in place when marked as Out
+                if not attr & SfBufferAttr.Out.value:
+                    attr |= SfBufferAttr.In.value
+            elif isinstance(first, CompactBuffer):
+                real_size = first.size
+                attr |= SfBufferAttr.In.value
+
+                if not compact_allowed:
+                    first = bytes(first)
             else:
                 real_size = sizeof(first)
                 attr |= SfBufferAttr.In.value
 
+                # Fixed-size inputs like paths and names are mostly padding
+                if compact_allowed and not isinstance(first, c_void_p):
+                    compact = CompactBuffer(bytes(first), real_size)
+                    if len(compact.data) + sizeof(c_uint32) < real_size:
+                        first = compact
+
             buffer_attrs.append(attr)
 
-            is_pointer = isinstance(first, c_void_p)
+            if isinstance(first, c_void_p):
+                kind = cls.Buffer.Pointer
+            elif isinstance(first, CompactBuffer):
+                kind = cls.Buffer.Compact
+            else:
+                kind = cls.Buffer.Inline
 
-            h.write(cls.Buffer(real_size, attr, is_pointer))
+            h.write(cls.Buffer(real_size, attr, kind))
 
-            if is_pointer:
+            if kind == cls.Buffer.Pointer:
                 h.write(first)
+            elif kind == cls.Buffer.Compact:
+                h.write(c_uint32(len(first.data)))
+                h.write(first.data)
             elif attr & SfBufferAttr.In.value:
                 h.write(first)
 
@@ -243,6 +274,239 @@ class DispatchToService(Command):
                 continue
 
             if attr & SfBufferAttr.Out.value:
-                out["buffers"].append(h.read(first))
+                if isinstance(first, memoryview):
+                    h.readinto(first)
+                    out["buffers"].append(first)
+                else:
+                    out["buffers"].append(h.read(first))
+
+        return out
+
+class WalkTree(Command):
+    id = 9
+
+    class Record(LittleEndianStructure):
+        _pack_ = 1
+        _fields_ = [
+            ("path_len", c_uint16),
+            ("type",     c_uint8),
+            ("size",     c_int64)
+        ]
+
+    class Options(LittleEndianStructure):
+        _fields_ = [
+            ("max_depth", c_uint32),
+            ("flags",     c_uint32)
+        ]
+
+    @classmethod
+    def execute(cls, h, service, path, max_depth=0, timestamps=False):
+        flags = 0
+        if timestamps:
+            flags |= 1 << 0
+
+        h.write(c_uint8(cls.id))
+        h.write(service)
+        h.write(cls.Options(max_depth, flags))
+        h.write(path)
+
+        records = []
+        while True:
+            size = h.read(c_uint32).value
+            if size == 0:
+                break
+
+            chunk = h.read(size)
+
+            offset = 0
+            while offset < size:
+                record = cls.Record.from_buffer_copy(chunk, offset)
+                offset += sizeof(record)
+
+                if timestamps:
+                    modified = c_uint64.from_buffer_copy(chunk, offset).value
+                    offset += sizeof(c_uint64)
+                else:
+                    modified = None
+
+                records.append((chunk[offset:offset + record.path_len].decode(), record.type, record.size, modified))
+                offset += record.path_len
+
+        result = h.read(Result)
+        if result.value != 0:
+            raise ResultException(result)
+
+        return records
+
+class UnpackFiles(Command):
+    id = 10
+
+    # Payloads must be sent in the same pieces the console reads them in
+    chunk_size   = 0x100000
+    max_path_len = 0x300
+
+    class FileHeader(LittleEndianStructure):
+        _fields_ = [
+            ("path_len", c_uint32),
+            ("size",     c_uint64)
+        ]
+
+    @classmethod
+    def execute(cls, h, service, files):
+        files = [(path.encode(), size, src) for path, size, src in files]
+        for path, size, src in files:
+            if len(path) > cls.max_path_len:
+                raise ValueError(f"Path too long: {path.decode()}")
+
+        h.write(c_uint8(cls.id))
+        h.write(service)
+        h.write(c_uint32(len(files)))
+
+        for path, size, src in files:
+            h.write(cls.FileHeader(len(path), size))
+            h.write(path)
+
+            if hasattr(src, "readinto"):
+                chunk = bytearray(min(size, cls.chunk_size))
+
+                for offset in range(0, size, cls.chunk_size):
+                    view = memoryview(chunk)[:min(size - offset, cls.chunk_size)]
+
+                    filled = 0
+                    while filled < len(view):
+                        read = src.readinto(view[filled:])
+                        if not read:
+                            raise EOFError(f"Source for {path.decode()} ended early")
+
+                        filled += read
+
+                    h.write(view)
+            else:
+                src = memoryview(src).cast("B")
+                for offset in range(0, size, cls.chunk_size):
+                    h.write(src[offset:offset + cls.chunk_size])
+
+        result = h.read(Result)
+        if result.value != 0:
+            raise ResultException(result)
+
+        if len(files) == 0:
+            return []
+
+        return list(h.read(Result * len(files)))
+
+class PackFiles(Command):
+    id = 11
+
+    chunk_size     = 0x100000
+    max_paths_size = 0x40000
+
+    class Info(LittleEndianStructure):
+        _fields_ = [
+            ("count",      c_uint32),
+            ("paths_size", c_uint32)
+        ]
+
+    class FileHeader(LittleEndianStructure):
+        _fields_ = [
+            ("result", Result),
+            ("pad",    c_uint32),
+            ("size",   c_int64)
+        ]
+
+    @classmethod
+    def execute(cls, h, service, paths):
+        blob = b"".join(x.encode() + b"\0" for x in paths)
+        if len(blob) > cls.max_paths_size:
+            raise ValueError(f"Too many paths: {len(blob):#x} bytes")
+
+        h.write(c_uint8(cls.id))
+        h.write(service)
+        h.write(cls.Info(len(paths), len(blob)))
+        h.write(blob)
+
+        result = h.read(Result)
+        if result.value != 0:
+            raise ResultException(result)
+
+        files = []
+        for path in paths:
+            header = h.read(cls.FileHeader)
+            if header.result.value != 0:
+                files.append((path, header.result, None))
+
+                continue
+
+            data = bytearray(header.size)
+            for offset in range(0, header.size, cls.chunk_size):
+                h.readinto(memoryview(data)[offset:offset + cls.chunk_size])
+
+            result = h.read(Result)
+            if result.value != 0:
+                data = None
+
+            files.append((path, result, data))
+
+        return files
+
+class Nop(Command):
+    id = 12
+
+    # Nothing is sent back, so any number of these can be used to fill out an interrupted payload
+    @classmethod
+    def execute(cls, h):
+        h.write(c_uint8(cls.id))
+
+class Ping(Command):
+    id = 13
+
+    magic = 0x474e50435049584e # "NXIPCPNG"
+
+    class Pong(LittleEndianStructure):
+        _fields_ = [
+            ("magic", c_uint64),
+            ("nonce", c_uint64)
+        ]
+
+    @classmethod
+    def send(cls, h, nonce):
+        h.write(c_uint8(cls.id))
+        h.write(c_uint64(nonce))
+
+    @classmethod
+    def pong(cls, nonce):
+        return bytes(cls.Pong(cls.magic, nonce))
+
+    @classmethod
+    def execute(cls, h, nonce=0):
+        cls.send(h, nonce)
+
+        pong = h.read(cls.Pong)
+        if pong.magic != cls.magic or pong.nonce != nonce:
+            raise IOError("Bad ping response")
+
+        return pong
+
+class EnableChannels(Command):
+    id    = 14
+    Input = c_uint32
+
+class GetDeviceInfo(Command):
+    id = 15
+
+    # Bits in capabilities
+    Ping          = 1 << 0
+    Channels      = 1 << 1
+    CompactBuffer = 1 << 2
+    PackFiles     = 1 << 3
+
+    class Output(LittleEndianStructure):
+        _fields_ = [
+            ("hos_version",      c_uint32),
+            ("protocol_version", c_uint32),
+            ("capabilities",     c_uint64)
+        ]
 
-        return out
\ No newline at end of file
+        @property
+        def version(self):
+            return HosVersion((self.hos_version >> 16) & 0xff, (self.hos_version >> 8) & 0xff, self.hos_version & 0xff)
@@ -0,0 +1,1242 @@
+import os
+import time
+import errno
+import shutil
+import posixpath
+import array
+import queue
+import threading
+import collections
+from ctypes import *
+
+from . import util, UsbCommandHandler
+from .types import ServiceStruct, SmServiceName, SfBufferAttr, HosVersion
+from .commands import *
+from .mux import Multiplexer
+from .services.audio import AudOut
+from .services.set import SetSys
+from .services.fs import FspSrv
+
+NXIPC_MODULE = 396
+
+# What the console reads and writes in one transfer, and the most it puts in one channel frame
+MAX_READ_WRITE = 0xe00
+MUX_FRAME_SIZE = 0x10000
+
+WALK_TREE_CHUNK_SIZE = 0x4000
+PACK_BUFFER_SIZE     = 0x100000
+PACK_PATHS_SIZE      = 0x40000
+
+def make_result(module, description):
+    return (module & 0x1ff) | ((description & 0x1fff) << 9)
+
+result_unknown_command = make_result(10, 221)
+result_invalid_handle  = make_result(1, 114)
+
+result_path_not_found      = make_result(2, 1)
+result_path_already_exists = make_result(2, 2)
+result_directory_not_empty = make_result(2, 8)
+result_fs_unexpected       = make_result(2, 5000)
+
+class DesyncError(Exception):
+    pass
+
+class Stopped(Exception):
+    pass
+
+class Endpoint:
+    # One direction of the link, where every write is a separate transfer
+    def __init__(self):
+        self.transfers = queue.Queue()
+
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.bytes_sent = 0
+        self.transfers_sent = 0
+
+    def put(self, data):
+        self.bytes_sent += len(data)
+        self.transfers_sent += 1
+
+        self.transfers.put(data)
+
+    def write(self, data, timeout=None):
+        data = bytes(data)
+        self.put(data)
+
+        return len(data)
+
+    def read(self, size, timeout=None):
+        if timeout is not None:
+            timeout /= 1000
+
+        try:
+            data = self.transfers.get(timeout=timeout)
+        except queue.Empty:
+            raise self.usb_error("USBTimeoutError", "Operation timed out")
+
+        if data is None:
+            raise self.usb_error("USBError", "Device stopped")
+
+        if len(data) > size:
+            raise self.usb_error("USBError", f"Overflow: {len(data):#x} bytes for a {size:#x} byte transfer")
+
+        return array.array("B", data)
+
+    @staticmethod
+    def usb_error(name, message):
+        # Fails the way pyusb does, which is only imported once something fails
+        import usb.core
+
+        return getattr(usb.core, name)(message)
+
+class Memory:
+    base = 0x80000000
+
+    def __init__(self):
+        self.blocks = {}
+        self.next = self.base
+
+        self.lock = threading.Lock()
+
+    def allocate(self, size, align=0x10):
+        with self.lock:
+            addr = util.align(self.next, max(align, 0x10))
+
+            # Keep a gap so overruns don't silently land in the next block
+            self.next = addr + max(size, 1) + 0x10
+            self.blocks[addr] = bytearray(size)
+
+            return addr
+
+    def free(self, addr):
+        with self.lock:
+            self.blocks.pop(addr, None)
+
+    def find(self, addr, size):
+        for start, block in self.blocks.items():
+            if start <= addr and addr + size <= start + len(block):
+                return block, addr - start
+
+        return None, None
+
+    def read(self, addr, size):
+        with self.lock:
+            block, offset = self.find(addr, size)
+
+            # Unmapped memory reads back as zeroes instead of crashing the console
+            if block is None:
+                return bytes(size)
+
+            return bytes(block[offset:offset + size])
+
+    def write(self, addr, data):
+        with self.lock:
+            block, offset = self.find(addr, len(data))
+            if block is not None:
+                block[offset:offset + len(data)] = data
+
+class Request:
+    def __init__(self, emulator, id, in_data, out_size, buffers, in_handles, out_num_objects, send_pid):
+        self.emulator = emulator
+
+        self.id = id
+        self.in_data = in_data
+        self.out_data = bytes(out_size)
+        self.buffers = buffers
+        self.in_handles = in_handles
+        self.out_num_objects = out_num_objects
+        self.send_pid = send_pid
+
+        self.out_objects = []
+
+    def input(self, type):
+        data = self.in_data[:sizeof(type)]
+
+        return type.from_buffer_copy(data + bytes(sizeof(type) - len(data)))
+
+    def output(self, value):
+        data = bytes(value)[:len(self.out_data)]
+        self.out_data = data + bytes(len(self.out_data) - len(data))
+
+    def string(self, index):
+        return bytes(self.buffers[index]).split(b"\0", 1)[0].decode()
+
+class EmulatedService:
+    # Maps request ids to the names of methods that take a Request and return a result
+    commands = {}
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def dispatch(self, request):
+        self.emulator.requests_handled[(type(self).__name__, request.id)] += 1
+
+        name = self.commands.get(request.id)
+        if name is None:
+            return result_unknown_command
+
+        return getattr(self, name)(request) or 0
+
+    def close(self):
+        pass
+
+class DeviceChannel:
+    def __init__(self, emulator, id):
+        self.emulator = emulator
+        self.id = id
+
+        self.inbound = bytearray()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        self.thread = threading.Thread(target=emulator.serve_channel, args=(self,), daemon=True)
+
+    def feed(self, data):
+        with self.cond:
+            self.inbound += data
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    @property
+    def finished(self):
+        with self.cond:
+            return self.closed and len(self.inbound) == 0
+
+    def read(self, size):
+        with self.cond:
+            while len(self.inbound) < size and not self.closed:
+                self.cond.wait()
+
+            # Like on the console, a closed channel reads as zeroes
+            data = bytes(self.inbound[:size])
+            del self.inbound[:size]
+
+            return data + bytes(size - len(data))
+
+    def write(self, data):
+        for start in range(0, len(data), MUX_FRAME_SIZE):
+            frame = data[start:start + MUX_FRAME_SIZE]
+
+            with self.emulator.write_lock:
+                if not self.closed:
+                    self.emulator.raw_write(bytes(Multiplexer.Header(self.id, len(frame))))
+                    self.emulator.raw_write(frame)
+
+# Stands in for the console end of the link, speaking the same protocol as main.c
+class Emulator:
+    commands = {
+        Exit.id:                   "exit",
+        Allocate.id:               "allocate",
+        Free.id:                   "free",
+        Read.id:                   "read",
+        Write.id:                  "write",
+        GetService.id:             "get_service",
+        CloseService.id:           "close_service",
+        ConvertServiceToDomain.id: "convert_service_to_domain",
+        DispatchToService.id:      "dispatch_to_service",
+        WalkTree.id:               "walk_tree",
+        UnpackFiles.id:            "unpack_files",
+        PackFiles.id:              "pack_files",
+        Nop.id:                    "nop",
+        Ping.id:                   "ping",
+        EnableChannels.id:         "enable_channels",
+        GetDeviceInfo.id:          "get_device_info",
+    }
+
+    max_channels = 8
+
+    hos_version = HosVersion(9,0,0)
+    capabilities = GetDeviceInfo.Ping | GetDeviceInfo.Channels | GetDeviceInfo.CompactBuffer | GetDeviceInfo.PackFiles
+
+    def __init__(self, services=None, latency=None, round_trip_latency=0, bandwidth=None):
+        # Named from the host's point of view
+        self.ep_out = Endpoint()
+        self.ep_in = Endpoint()
+
+        self.memory = Memory()
+
+        # Service names to callables that take the emulator and return an EmulatedService
+        self.services = dict(services or {})
+
+        # Extra seconds spent on each command, per channel id
+        self.latency = dict(latency or {})
+
+        # Extra seconds spent on every command, and the most bytes per second the link carries
+        self.round_trip_latency = round_trip_latency
+        self.bandwidth = bandwidth
+        self.link_debt = 0.0
+
+        self.objects = {}
+        self.next_handle = 0x100
+        self.next_object_id = 1
+        self.objects_lock = threading.Lock()
+
+        self.write_lock = threading.Lock()
+        self.local = threading.local()
+
+        self.reset_counters()
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+        return self
+
+    def stop(self):
+        self.ep_out.transfers.put(None)
+        self.thread.join()
+
+    def handler(self, **kwargs):
+        return EmulatedHandler(self, **kwargs)
+
+    def reset_counters(self):
+        self.ep_out.reset_counters()
+        self.ep_in.reset_counters()
+
+        self.commands_handled = 0
+        self.command_counts = collections.Counter()
+        self.requests_handled = collections.Counter()
+
+    @property
+    def stats(self):
+        return {
+            "commands":       self.commands_handled,
+            "bytes_out":      self.ep_out.bytes_sent,
+            "bytes_in":       self.ep_in.bytes_sent,
+            "transfers_out":  self.ep_out.transfers_sent,
+            "transfers_in":   self.ep_in.transfers_sent,
+        }
+
+    def throttle(self, size):
+        if self.bandwidth is None:
+            return
+
+        # Sleeping for every transfer would mostly measure the scheduler, so catch up in bigger steps
+        self.link_debt += size / self.bandwidth
+        if self.link_debt >= 0.001:
+            time.sleep(self.link_debt)
+            self.link_debt = 0.0
+
+    # Link
+
+    def raw_read(self, size):
+        data = bytearray()
+
+        while len(data) < size:
+            to_read = min(size - len(data), MAX_READ_WRITE)
+
+            transfer = self.ep_out.transfers.get()
+            if transfer is None:
+                raise Stopped()
+
+            # The console would get a short read or overflow here and lose its place
+            if len(transfer) != to_read:
+                raise DesyncError(f"Host sent {len(transfer):#x} bytes for a {to_read:#x} byte read")
+
+            self.throttle(len(transfer))
+            data += transfer
+
+        return bytes(data)
+
+    def raw_write(self, data):
+        data = bytes(data)
+
+        for start in range(0, len(data), MAX_READ_WRITE):
+            self.throttle(min(len(data) - start, MAX_READ_WRITE))
+            self.ep_in.put(data[start:start + MAX_READ_WRITE])
+
+    def usb_read(self, size_or_type):
+        if isinstance(size_or_type, int):
+            size = size_or_type
+        else:
+            size = sizeof(size_or_type)
+
+        channel = getattr(self.local, "channel", None)
+        if channel is not None:
+            data = channel.read(size)
+        else:
+            data = self.raw_read(size)
+
+        if isinstance(size_or_type, int):
+            return data
+
+        return size_or_type.from_buffer_copy(data)
+
+    def usb_write(self, data):
+        data = bytes(data)
+        if len(data) == 0:
+            return
+
+        channel = getattr(self.local, "channel", None)
+        if channel is not None:
+            channel.write(data)
+        else:
+            self.raw_write(data)
+
+    def write_result(self, rc):
+        self.usb_write(c_uint32(rc))
+
+    # Command loop
+
+    def run(self):
+        try:
+            while True:
+                cmd_id = self.usb_read(1)[0]
+
+                if self.handle_command(cmd_id):
+                    break
+        except Stopped:
+            pass
+        except Exception as e:
+            self.error = e
+
+    def handle_command(self, cmd_id):
+        self.commands_handled += 1
+
+        name = self.commands.get(cmd_id)
+        if name is None:
+            self.write_result(make_result(NXIPC_MODULE, 2))
+
+            return False
+
+        self.command_counts[name] += 1
+
+        if self.round_trip_latency:
+            time.sleep(self.round_trip_latency)
+
+        return getattr(self, name)() is True
+
+    def serve_channel(self, channel):
+        self.local.channel = channel
+
+        try:
+            while True:
+                cmd_id = self.usb_read(1)[0]
+                if channel.finished:
+                    break
+
+                latency = self.latency.get(channel.id)
+                if latency:
+                    time.sleep(latency)
+
+                if self.handle_command(cmd_id):
+                    break
+        except Exception as e:
+            self.error = e
+
+    # Objects
+
+    def add_object(self, service, session=None, object_id=0):
+        with self.objects_lock:
+            if session is None:
+                session = self.next_handle
+                self.next_handle += 1
+
+            self.objects[(session, object_id)] = service
+
+            return session
+
+    def new_object_id(self):
+        with self.objects_lock:
+            object_id = self.next_object_id
+            self.next_object_id += 1
+
+            return object_id
+
+    def get_object(self, s):
+        with self.objects_lock:
+            return self.objects.get((s.session, s.object_id))
+
+    def remove_objects(self, s):
+        with self.objects_lock:
+            # Closing a session closes every object in its domain
+            if s.own_handle != 0:
+                keys = [x for x in self.objects if x[0] == s.session]
+            else:
+                keys = [(s.session, s.object_id)]
+
+            removed = [self.objects.pop(x) for x in keys if x in self.objects]
+
+        for obj in removed:
+            obj.close()
+
+    # Commands
+
+    def exit(self):
+        self.write_result(0)
+
+        return True
+
+    def allocate(self):
+        alloc = self.usb_read(Allocate.Allocation)
+
+        if alloc.type == 2:
+            align = self.usb_read(c_uint64).value
+        elif alloc.type in (0, 1):
+            align = 0x10
+        else:
+            self.write_result(make_result(NXIPC_MODULE, 3))
+
+            return
+
+        ptr = self.memory.allocate(alloc.size, align)
+
+        self.write_result(0)
+        self.usb_write(c_uint64(ptr))
+
+    def free(self):
+        self.memory.free(self.usb_read(c_uint64).value)
+
+        self.write_result(0)
+
+    def read(self):
+        info = self.usb_read(Read.Info)
+
+        self.write_result(0)
+        self.usb_write(self.memory.read(info.ptr or 0, info.size))
+
+    def write(self):
+        info = self.usb_read(Write.Info)
+
+        self.memory.write(info.ptr or 0, self.usb_read(info.size))
+
+        self.write_result(0)
+
+    def get_service(self):
+        name = self.usb_read(SmServiceName).name
+
+        factory = self.services.get(name)
+        if factory is None:
+            self.write_result(make_result(NXIPC_MODULE, 1))
+
+            return
+
+        s = ServiceStruct(0, 1, 0, 0x800)
+        s.session = self.add_object(factory(self))
+
+        self.write_result(0)
+        self.usb_write(s)
+
+    def close_service(self):
+        self.remove_objects(self.usb_read(ServiceStruct))
+
+        self.write_result(0)
+
+    def convert_service_to_domain(self):
+        s = self.usb_read(ServiceStruct)
+
+        with self.objects_lock:
+            obj = self.objects.pop((s.session, 0), None)
+
+        if obj is None:
+            self.write_result(result_invalid_handle)
+
+            return
+
+        s.object_id = self.new_object_id()
+        self.add_object(obj, s.session, s.object_id)
+
+        self.write_result(0)
+        self.usb_write(s)
+
+    def dispatch_to_service(self):
+        header = self.usb_read(DispatchToService.Header)
+
+        in_data = self.usb_read(header.in_size)
+
+        buffers = []
+        attrs = []
+        pointers = {}
+        for i in range(header.num_buffers):
+            buffer = self.usb_read(DispatchToService.Buffer)
+            attrs.append(buffer.attr)
+
+            if buffer.kind == DispatchToService.Buffer.Pointer:
+                ptr = self.usb_read(c_uint64).value
+                pointers[i] = ptr
+
+                buffers.append(bytearray(self.memory.read(ptr, buffer.size)))
+            elif buffer.kind == DispatchToService.Buffer.Compact:
+                data = self.usb_read(self.usb_read(c_uint32).value)
+
+                buffers.append(bytearray(data + bytes(buffer.size - len(data))))
+            elif buffer.attr & SfBufferAttr.In.value:
+                buffers.append(bytearray(self.usb_read(buffer.size)))
+            else:
+                buffers.append(bytearray(buffer.size))
+
+        in_handles = [self.usb_read(c_uint32).value for i in range(header.in_num_handles)]
+
+        request = Request(self, header.request_id, in_data, header.out_size, buffers,
+                          in_handles, header.out_num_objects, header.in_send_pid)
+
+        obj = self.get_object(header.service)
+        if obj is None:
+            rc = result_invalid_handle
+        else:
+            rc = obj.dispatch(request)
+
+        # Pointer buffers were passed straight through, so outputs land in the host's memory
+        for i, ptr in pointers.items():
+            if attrs[i] & SfBufferAttr.Out.value:
+                self.memory.write(ptr, buffers[i])
+
+        self.write_result(rc)
+        if rc != 0:
+            return
+
+        self.usb_write(request.out_data)
+
+        if header.out_num_objects > 0:
+            out_objects = (ServiceStruct * header.out_num_objects)()
+
+            for i, child in enumerate(request.out_objects[:header.out_num_objects]):
+                s = out_objects[i]
+                s.pointer_buffer_size = header.service.pointer_buffer_size
+
+                # Objects from a domain stay in it, otherwise they get a session of their own
+                if header.service.object_id != 0:
+                    s.session = header.service.session
+                    s.object_id = self.new_object_id()
+
+                    self.add_object(child, s.session, s.object_id)
+                else:
+                    s.own_handle = 1
+                    s.session = self.add_object(child)
+
+            self.usb_write(out_objects)
+
+        for i, buffer in enumerate(buffers):
+            if i not in pointers and attrs[i] & SfBufferAttr.Out.value:
+                self.usb_write(buffer)
+
+    def file_system(self):
+        obj = self.get_object(self.usb_read(ServiceStruct))
+        if not isinstance(obj, EmulatedFileSystem):
+            return None
+
+        return obj
+
+    def walk_tree(self):
+        fs = self.file_system()
+        options = self.usb_read(WalkTree.Options)
+        path = self.usb_read(FspSrv.FileSystem.PathType).value.decode()
+
+        chunk = bytearray()
+
+        def flush():
+            if len(chunk) > 0:
+                self.usb_write(c_uint32(len(chunk)))
+                self.usb_write(chunk)
+
+                chunk.clear()
+
+        # Same order and chunking as the console: a directory's entries, then its subdirectories
+        def walk(dir_path, depth_left):
+            subdirs = []
+
+            for name, type, size in fs.list_dir(dir_path):
+                entry_path = dir_path.rstrip("/") + "/" + name
+                relative = entry_path[len(path.rstrip("/")) + 1:].encode()
+
+                record = bytes(WalkTree.Record(len(relative), type, size))
+                if options.flags & 1:
+                    record += bytes(c_uint64(fs.timestamp(entry_path).modified if type == 1 else 0))
+
+                if len(chunk) + sizeof(WalkTree.Record) + sizeof(c_uint64) + len(relative) > WALK_TREE_CHUNK_SIZE:
+                    flush()
+
+                chunk.extend(record + relative)
+
+                if type == 0 and depth_left != 1:
+                    subdirs.append(entry_path)
+
+            for subdir in subdirs:
+                walk(subdir, depth_left - 1 if depth_left > 0 else 0)
+
+        if fs is None:
+            rc = result_invalid_handle
+        else:
+            rc = fs.call(walk, path, options.max_depth)
+
+        flush()
+
+        self.usb_write(c_uint32(0))
+        self.write_result(rc)
+
+    def unpack_files(self):
+        fs = self.file_system()
+        count = self.usb_read(c_uint32).value
+
+        results = []
+        for i in range(count):
+            header = self.usb_read(UnpackFiles.FileHeader)
+            path = self.usb_read(header.path_len)
+
+            # The payload is always read, to stay in sync
+            chunks = (self.usb_read(min(header.size - offset, PACK_BUFFER_SIZE)) for offset in range(0, header.size, PACK_BUFFER_SIZE))
+
+            if header.path_len >= sizeof(FspSrv.FileSystem.PathType):
+                rc = make_result(NXIPC_MODULE, 5)
+            elif fs is None:
+                rc = result_invalid_handle
+            else:
+                rc = fs.call(fs.unpack_file, path.decode(), chunks)
+
+            for chunk in chunks:
+                pass
+
+            results.append(rc)
+
+        self.write_result(0)
+        self.usb_write((Result * count)(*(Result(x) for x in results)))
+
+    def pack_files(self):
+        fs = self.file_system()
+        info = self.usb_read(PackFiles.Info)
+
+        if info.paths_size > PACK_PATHS_SIZE:
+            self.write_result(make_result(NXIPC_MODULE, 5))
+
+            return
+
+        paths = self.usb_read(info.paths_size).split(b"\0")
+
+        self.write_result(0)
+
+        for i in range(info.count):
+            if i >= len(paths) - 1 or fs is None:
+                self.usb_write(PackFiles.FileHeader(Result(make_result(NXIPC_MODULE, 5) if fs is not None else result_invalid_handle)))
+
+                continue
+
+            host_path = fs.host_path(paths[i].decode())
+
+            try:
+                f = open(host_path, "rb")
+            except OSError as e:
+                self.usb_write(PackFiles.FileHeader(Result(fs.result(e))))
+
+                continue
+
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                self.usb_write(PackFiles.FileHeader(Result(0), 0, size))
+
+                for offset in range(0, size, PACK_BUFFER_SIZE):
+                    to_read = min(size - offset, PACK_BUFFER_SIZE)
+
+                    data = f.read(to_read)
+                    self.usb_write(data + bytes(to_read - len(data)))
+
+            self.write_result(0)
+
+    def nop(self):
+        pass
+
+    def ping(self):
+        nonce = self.usb_read(c_uint64).value
+
+        self.usb_write(Ping.Pong(Ping.magic, nonce))
+
+    def enable_channels(self):
+        count = self.usb_read(c_uint32).value
+
+        if getattr(self.local, "channel", None) is not None:
+            self.write_result(make_result(NXIPC_MODULE, 2))
+
+            return
+
+        if count == 0 or count > self.max_channels:
+            self.write_result(make_result(NXIPC_MODULE, 6))
+
+            return
+
+        channels = [DeviceChannel(self, i) for i in range(count)]
+        for channel in channels:
+            channel.thread.start()
+
+        self.write_result(0)
+
+        while True:
+            header = Multiplexer.Header.from_buffer_copy(self.raw_read(sizeof(Multiplexer.Header)))
+            if header.channel == Multiplexer.control_channel:
+                break
+
+            data = self.raw_read(header.size)
+            if header.channel < count:
+                channels[header.channel].feed(data)
+
+        for channel in channels:
+            channel.close()
+
+        for channel in channels:
+            channel.thread.join()
+
+        self.raw_write(Multiplexer.Header(Multiplexer.control_channel, 0))
+
+    def get_device_info(self):
+        self.write_result(0)
+        self.usb_write(GetDeviceInfo.Output(self.hos_version.packed, 1, self.capabilities))
+
+class EmulatedHandler(UsbCommandHandler):
+    def __init__(self, emulator, **kwargs):
+        self.emulator = emulator
+
+        super().__init__(**kwargs)
+
+    def connect(self):
+        self.dev = None
+        self.serial = f"emulator-{id(self.emulator):x}"
+        self.ep = (self.emulator.ep_out, self.emulator.ep_in)
+
+# Services
+
+class EmulatedAudioOut(EmulatedService):
+    # Plays appended buffers in real time at a fixed rate, without looking at what's in them
+    commands = {
+        0:  "get_state",
+        1:  "start",
+        2:  "stop",
+        3:  "append_buffer",
+        5:  "get_released_buffers",
+        6:  "contains_buffer",
+        7:  "append_buffer",
+        8:  "get_released_buffers",
+        9:  "get_buffer_count",
+        10: "get_played_sample_count",
+    }
+
+    def __init__(self, emulator, sample_rate=48000, channel_count=2):
+        super().__init__(emulator)
+
+        self.sample_rate = sample_rate
+        self.channel_count = channel_count
+
+        # Tags and how many frames they have left to play
+        self.queue = collections.deque()
+        self.released = collections.deque()
+
+        self.started = False
+        self.clock = time.monotonic()
+        self.played = 0.0
+
+        self.starved = False
+        self.underruns = 0
+
+        self.lock = threading.Lock()
+
+    def advance(self):
+        now = time.monotonic()
+
+        if self.started:
+            budget = (now - self.clock) * self.sample_rate
+
+            while len(self.queue) > 0 and budget > 0:
+                entry = self.queue[0]
+
+                played = min(entry[1], budget)
+                entry[1] -= played
+                budget -= played
+                self.played += played
+
+                if entry[1] <= 0:
+                    self.released.append(self.queue.popleft()[0])
+
+            if len(self.queue) == 0 and budget > 0 and not self.starved:
+                self.starved = True
+                self.underruns += 1
+
+        self.clock = now
+
+    def get_state(self, request):
+        request.output(c_uint32(AudOut.State.Started.value if self.started else AudOut.State.Stopped.value))
+
+    def start(self, request):
+        with self.lock:
+            self.advance()
+            self.started = True
+
+    def stop(self, request):
+        with self.lock:
+            self.advance()
+            self.started = False
+
+    def append_buffer(self, request):
+        buffer = AudOut.Buffer.from_buffer_copy(bytes(request.buffers[0]))
+
+        with self.lock:
+            self.advance()
+
+            self.queue.append([request.input(c_uint64).value, buffer.data_size // (2 * self.channel_count)])
+            self.starved = False
+
+    def get_released_buffers(self, request):
+        with self.lock:
+            self.advance()
+
+            count = min(len(self.released), len(request.buffers[0]) // sizeof(c_uint64))
+            for i in range(count):
+                request.buffers[0][i * 8:(i + 1) * 8] = bytes(c_uint64(self.released.popleft()))
+
+        request.output(c_uint32(count))
+
+    def contains_buffer(self, request):
+        tag = request.input(c_uint64).value
+
+        with self.lock:
+            self.advance()
+
+            contained = any(x[0] == tag for x in self.queue) or tag in self.released
+
+        request.output(c_bool(contained))
+
+    def get_buffer_count(self, request):
+        with self.lock:
+            self.advance()
+
+            request.output(c_uint32(len(self.queue)))
+
+    def get_played_sample_count(self, request):
+        with self.lock:
+            self.advance()
+
+            request.output(c_uint64(int(self.played)))
+
+class EmulatedAudOut(EmulatedService):
+    commands = {
+        0: "list_audio_outs",
+        1: "open_audio_out",
+        2: "list_audio_outs",
+        3: "open_audio_out",
+    }
+
+    device_name = b"DeviceOut"
+
+    class Out(LittleEndianStructure):
+        _fields_ = [
+            ("sample_rate",   c_uint32),
+            ("channel_count", c_uint32),
+            ("pcm_format",    c_uint32),
+            ("state",         c_uint32)
+        ]
+
+    def __init__(self, emulator, sample_rate=48000, channel_count=2):
+        super().__init__(emulator)
+
+        self.sample_rate = sample_rate
+        self.channel_count = channel_count
+
+        self.outs = []
+
+    def list_audio_outs(self, request):
+        request.buffers[0][:len(self.device_name)] = self.device_name
+
+        request.output(c_uint32(1))
+
+    def open_audio_out(self, request):
+        # Whatever's asked for, the device plays what it supports
+        audio_out = EmulatedAudioOut(self.emulator, self.sample_rate, self.channel_count)
+        self.outs.append(audio_out)
+
+        request.buffers[1][:len(self.device_name)] = self.device_name
+        request.output(self.Out(self.sample_rate, self.channel_count, 2, AudOut.State.Stopped.value))
+        request.out_objects.append(audio_out)
+
+class EmulatedSetSys(EmulatedService):
+    commands = {
+        3: "get_firmware_version",
+        4: "get_firmware_version",
+    }
+
+    def get_firmware_version(self, request):
+        version = self.emulator.hos_version
+
+        fw = SetSys.FirmwareVersion(version.major, version.minor, version.micro)
+        fw.display_version = f"{version.major}.{version.minor}.{version.micro}".encode()
+
+        request.buffers[0][:sizeof(fw)] = bytes(fw)
+
+class EmulatedFsObject(EmulatedService):
+    # Host errors come back as the results the console would give
+    @staticmethod
+    def result(error):
+        if isinstance(error, FileNotFoundError):
+            return result_path_not_found
+
+        if isinstance(error, FileExistsError):
+            return result_path_already_exists
+
+        if isinstance(error, OSError) and error.errno == errno.ENOTEMPTY:
+            return result_directory_not_empty
+
+        return result_fs_unexpected
+
+    def call(self, func, *args):
+        try:
+            return func(*args) or 0
+        except OSError as e:
+            return self.result(e)
+
+    def dispatch(self, request):
+        return self.call(super().dispatch, request)
+
+class EmulatedFile(EmulatedFsObject):
+    commands = {
+        0: "read",
+        1: "write",
+        2: "flush",
+        3: "set_size",
+        4: "get_size",
+    }
+
+    def __init__(self, emulator, host_path, mode):
+        super().__init__(emulator)
+
+        self.file = open(host_path, "r+b" if mode & 0b110 else "rb")
+
+    def read(self, request):
+        info = request.input(FspSrv.FileSystem.File.In)
+
+        self.file.seek(info.offset)
+        data = self.file.read(min(info.size, len(request.buffers[0])))
+
+        request.buffers[0][:len(data)] = data
+        request.output(c_uint64(len(data)))
+
+    def write(self, request):
+        info = request.input(FspSrv.FileSystem.File.In)
+
+        self.file.seek(info.offset)
+        self.file.write(request.buffers[0][:info.size])
+
+        if info.option & 1:
+            self.file.flush()
+
+    def flush(self, request):
+        self.file.flush()
+
+    def set_size(self, request):
+        self.file.truncate(request.input(c_int64).value)
+
+    def get_size(self, request):
+        self.file.flush()
+
+        request.output(c_int64(os.fstat(self.file.fileno()).st_size))
+
+    def close(self):
+        self.file.close()
+
+class EmulatedDirectory(EmulatedFsObject):
+    commands = {
+        0: "read",
+        1: "get_entry_count",
+    }
+
+    def __init__(self, emulator, entries):
+        super().__init__(emulator)
+
+        self.entries = entries
+
+    def read(self, request):
+        Entry = FspSrv.FileSystem.Directory.Entry
+
+        count = min(len(self.entries), len(request.buffers[0]) // sizeof(Entry))
+        for i, (name, type, size) in enumerate(self.entries[:count]):
+            request.buffers[0][i * sizeof(Entry):(i + 1) * sizeof(Entry)] = bytes(Entry(name.encode(), type=type, size=size))
+
+        del self.entries[:count]
+
+        request.output(c_int64(count))
+
+    def get_entry_count(self, request):
+        request.output(c_int64(len(self.entries)))
+
+class EmulatedFileSystem(EmulatedFsObject):
+    # Backed by a directory on the host, with the console's paths relative to it
+    commands = {
+        0:  "create_file",
+        1:  "delete_file",
+        2:  "create_directory",
+        3:  "delete_directory",
+        4:  "delete_directory_recursively",
+        5:  "rename_file",
+        6:  "rename_directory",
+        7:  "get_entry_type",
+        8:  "open_file",
+        9:  "open_directory",
+        10: "commit",
+        11: "get_free_space_size",
+        12: "get_total_space_size",
+        13: "clean_directory_recursively",
+        14: "get_file_timestamp_raw",
+    }
+
+    class CreateFileIn(LittleEndianStructure):
+        _fields_ = [
+            ("option", c_uint32),
+            ("size",   c_int64),
+        ]
+
+    def __init__(self, emulator, root):
+        super().__init__(emulator)
+
+        self.root = os.path.realpath(root)
+
+    def host_path(self, path):
+        # Paths can't get out of the root, like they can't get out of a real filesystem
+        path = posixpath.normpath("/" + path.lstrip("/")).lstrip("/")
+
+        return os.path.join(self.root, *path.split("/")) if path else self.root
+
+    def path(self, request, index=0):
+        return self.host_path(request.string(index))
+
+    def list_dir(self, path, mode=0b11):
+        entries = []
+
+        with os.scandir(self.host_path(path)) as it:
+            for entry in sorted(it, key=lambda x: x.name):
+                if entry.is_dir():
+                    if mode & 0b01:
+                        entries.append((entry.name, 0, 0))
+                elif mode & 0b10:
+                    entries.append((entry.name, 1, entry.stat().st_size))
+
+        return entries
+
+    def timestamp(self, path):
+        st = os.stat(self.host_path(path))
+
+        return FspSrv.FileSystem.FileTimestamp(int(st.st_ctime), int(st.st_mtime), int(st.st_atime), True)
+
+    def unpack_file(self, path, chunks):
+        host_path = self.host_path(path)
+
+        os.makedirs(os.path.dirname(host_path), exist_ok=True)
+
+        with open(host_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def create_file(self, request):
+        info = request.input(self.CreateFileIn)
+
+        with open(self.path(request), "xb") as f:
+            f.truncate(info.size)
+
+    def delete_file(self, request):
+        path = self.path(request)
+        if os.path.isdir(path):
+            raise FileNotFoundError(path)
+
+        os.remove(path)
+
+    def create_directory(self, request):
+        os.mkdir(self.path(request))
+
+    def delete_directory(self, request):
+        os.rmdir(self.path(request))
+
+    def delete_directory_recursively(self, request):
+        path = self.path(request)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(path)
+
+        shutil.rmtree(path)
+
+    def rename_file(self, request):
+        old, new = self.path(request, 0), self.path(request, 1)
+        if os.path.exists(new):
+            raise FileExistsError(new)
+
+        os.rename(old, new)
+
+    def rename_directory(self, request):
+        self.rename_file(request)
+
+    def get_entry_type(self, request):
+        path = self.path(request)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+
+        request.output(c_uint32(0 if os.path.isdir(path) else 1))
+
+    def open_file(self, request):
+        path = self.path(request)
+        if os.path.isdir(path):
+            raise FileNotFoundError(path)
+
+        request.out_objects.append(EmulatedFile(self.emulator, path, request.input(c_uint32).value))
+
+    def open_directory(self, request):
+        entries = self.list_dir(request.string(0), request.input(c_uint32).value)
+
+        request.out_objects.append(EmulatedDirectory(self.emulator, entries))
+
+    def commit(self, request):
+        pass
+
+    def get_free_space_size(self, request):
+        request.output(c_int64(shutil.disk_usage(self.path(request)).free))
+
+    def get_total_space_size(self, request):
+        request.output(c_int64(shutil.disk_usage(self.path(request)).total))
+
+    def clean_directory_recursively(self, request):
+        path = self.path(request)
+
+        for entry in os.listdir(path):
+            entry_path = os.path.join(path, entry)
+
+            if os.path.isdir(entry_path):
+                shutil.rmtree(entry_path)
+            else:
+                os.remove(entry_path)
+
+    def get_file_timestamp_raw(self, request):
+        path = self.path(request)
+        if os.path.isdir(path):
+            raise FileNotFoundError(path)
+
+        request.output(self.timestamp(request.string(0)))
+
+class EmulatedFspSrv(EmulatedService):
+    commands = {
+        1:  "set_current_process",
+        11: "open_bis_file_system",
+        18: "open_sd_card_file_system",
+        27: "is_exfat_supported",
+    }
+
+    # The SD card is the root itself, BIS partitions are directories named after them in it
+    def __init__(self, emulator, root):
+        super().__init__(emulator)
+
+        self.root = root
+
+    def set_current_process(self, request):
+        pass
+
+    def open_bis_file_system(self, request):
+        partition = FspSrv.BisPartitionId(request.input(c_uint32).value)
+
+        path = os.path.join(self.root, partition.name)
+        if not os.path.isdir(path):
+            return result_path_not_found
+
+        request.out_objects.append(EmulatedFileSystem(self.emulator, path))
+
+    def open_sd_card_file_system(self, request):
+        request.out_objects.append(EmulatedFileSystem(self.emulator, self.root))
+
+    def is_exfat_supported(self, request):
+        request.output(c_bool(True))
@@ -0,0 +1,175 @@
+import time
+import threading
+from ctypes import *
+
+from . import util, CommandHandler
+from .types import Priority
+from .commands import EnableChannels
+
+class Multiplexer:
+    control_channel = 0xffffffff
+
+    # Seconds to wait for the console to acknowledge closing, on top of a read timeout
+    close_timeout = 5
+
+    # Must not be bigger than what the console reads a frame into
+    frame_size = 0x10000
+
+    class Header(LittleEndianStructure):
+        _fields_ = [
+            ("channel", c_uint32),
+            ("size",    c_uint32)
+        ]
+
+    def __init__(self, h, count=2):
+        h.execute(EnableChannels, count, priority=Priority.High)
+
+        self.h = h
+        h.mux = self
+
+        self.write_lock = threading.Lock()
+        self.closing = False
+        self.close_time = None
+        self.done = False
+        self.error = None
+
+        self.channels = [Channel(self, i) for i in range(count)]
+
+        self.reader = threading.Thread(target=self.read_frames, daemon=True)
+        self.reader.start()
+
+    def __getitem__(self, index):
+        return self.channels[index]
+
+    def __len__(self):
+        return len(self.channels)
+
+    def send(self, channel, data):
+        view = memoryview(data).cast("B")
+
+        # Frames from different channels can go in between each other's
+        for start in range(0, view.nbytes, self.frame_size):
+            frame = view[start:start + self.frame_size]
+
+            with self.write_lock:
+                self.h.write(self.Header(channel, frame.nbytes))
+                self.h.write(frame)
+
+    def read_header(self):
+        import usb.core
+
+        while True:
+            try:
+                data = self.h.ep[1].read(sizeof(self.Header), timeout=self.h.timeout)
+            except usb.core.USBTimeoutError:
+                # Channels are allowed to be idle, but not after the console was told to close them
+                if self.closing and time.monotonic() - self.close_time > self.close_timeout:
+                    raise IOError("Console didn't acknowledge closing its channels")
+
+                continue
+
+            return self.Header.from_buffer_copy(bytes(data))
+
+    def read_frames(self):
+        try:
+            while True:
+                header = self.read_header()
+                if header.channel == self.control_channel:
+                    break
+
+                data = self.h.read(header.size)
+                if header.channel < len(self.channels):
+                    self.channels[header.channel].feed(data)
+        except Exception as e:
+            self.error = e
+
+        self.done = True
+        for channel in self.channels:
+            channel.feed(b"")
+
+    def close(self):
+        if self.closing:
+            return
+
+        self.close_time = time.monotonic()
+        self.closing = True
+
+        # The console closes its channels and acknowledges with a control frame of its own
+        with self.write_lock:
+            self.h.write(self.Header(self.control_channel, 0))
+
+        self.reader.join(self.close_timeout + self.h.timeout / 1000 * 2)
+        if self.reader.is_alive() and self.error is None:
+            self.error = IOError("Timed out waiting for the channels to close")
+
+        for channel in self.channels:
+            channel.closed = True
+
+        self.h.mux = None
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class Channel(CommandHandler):
+    def __init__(self, mux, id):
+        super().__init__()
+
+        self.multiplexer = mux
+        self.id = id
+
+        self.inbound = bytearray()
+        self.cond = threading.Condition()
+
+    @property
+    def timeout(self):
+        return self.multiplexer.h.timeout
+
+    @property
+    def max_rw(self):
+        return self.multiplexer.h.max_rw
+
+    @property
+    def capabilities(self):
+        return self.multiplexer.h.capabilities
+
+    def feed(self, data):
+        with self.cond:
+            self.inbound += data
+            self.cond.notify_all()
+
+    def write(self, *args):
+        view = util.byte_view(*args)
+        if view.nbytes == 0:
+            return
+
+        self.multiplexer.send(self.id, view)
+
+    def readinto(self, buf):
+        view = memoryview(buf).cast("B")
+        size = view.nbytes
+
+        pos = 0
+        with self.cond:
+            while pos < size:
+                while len(self.inbound) == 0:
+                    if self.multiplexer.error is not None:
+                        raise IOError(f"Channel {self.id} lost: {self.multiplexer.error}")
+
+                    if self.multiplexer.done:
+                        raise IOError(f"Channel {self.id} closed")
+
+                    self.cond.wait()
+
+                to_copy = min(size - pos, len(self.inbound))
+                view[pos:pos + to_copy] = self.inbound[:to_copy]
+                del self.inbound[:to_copy]
+
+                pos += to_copy
+
+        return size
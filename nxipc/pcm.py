@@ -0,0 +1,170 @@
+import enum
+
+import numpy as np
+
+class PcmFormat(enum.IntEnum):
+    Invalid = 0
+    Int8    = 1
+    Int16   = 2
+    Int24   = 3
+    Int32   = 4
+    Float   = 5
+    Adpcm   = 6
+
+dtypes = {
+    PcmFormat.Int8:  np.dtype("<i1"),
+    PcmFormat.Int16: np.dtype("<i2"),
+    PcmFormat.Int32: np.dtype("<i4"),
+    PcmFormat.Float: np.dtype("<f4"),
+}
+
+class Converter:
+    # Converts interleaved PCM blocks of any size to what an AudioOut plays,
+    # keeping whatever's needed between blocks so the output is continuous
+    def __init__(self, src_rate, src_channels, dst_rate=48000, dst_channels=2,
+                 src_format=PcmFormat.Int16, dst_format=PcmFormat.Int16, gain=1.0):
+        if src_format not in dtypes or dst_format not in dtypes:
+            raise ValueError("Unsupported PCM format")
+
+        self.src_rate = src_rate
+        self.src_channels = src_channels
+        self.dst_rate = dst_rate
+        self.dst_channels = dst_channels
+
+        self.src_dtype = dtypes[src_format]
+        self.dst_dtype = dtypes[dst_format]
+
+        self.gain = gain
+
+        self.matrix = self.mix_matrix(src_channels, dst_channels)
+
+        # Bytes of a frame cut off at the end of the last block
+        self.carry = b""
+
+        # Where the next output frame falls, relative to the first frame of the next block
+        self.position = 0.0
+        self.last = None
+
+    @classmethod
+    def for_audio_out(cls, out, src_rate, src_channels, *args, **kwargs):
+        # Takes the last thing returned by AudOut.open_audio_out
+        return cls(src_rate, src_channels, out.sample_rate, out.channel_count, *args, dst_format=PcmFormat(out.pcm_format), **kwargs)
+
+    @staticmethod
+    def mix_matrix(src_channels, dst_channels):
+        if src_channels == dst_channels:
+            return None
+
+        matrix = np.zeros((src_channels, dst_channels), dtype=np.float32)
+
+        if src_channels > dst_channels:
+            # Fold extra channels down and average them
+            for i in range(src_channels):
+                matrix[i, i % dst_channels] = 1
+
+            matrix /= matrix.sum(axis=0)
+        else:
+            # Repeat channels to fill the extra ones, so mono goes to both sides
+            for i in range(dst_channels):
+                matrix[i % src_channels, i] = 1
+
+        return matrix
+
+    @staticmethod
+    def to_float(samples):
+        if samples.dtype.kind == "f":
+            return samples.astype(np.float32, copy=False)
+
+        return samples.astype(np.float32) / -np.iinfo(samples.dtype).min
+
+    def from_float(self, samples):
+        if self.dst_dtype.kind == "f":
+            return np.clip(samples, -1, 1).astype(self.dst_dtype)
+
+        info = np.iinfo(self.dst_dtype)
+
+        return np.clip(np.rint(samples * -info.min), info.min, info.max).astype(self.dst_dtype)
+
+    def frames(self, block):
+        if isinstance(block, np.ndarray):
+            if block.ndim == 2:
+                return block
+
+            return block.reshape(-1, self.src_channels)
+
+        data = self.carry + bytes(block)
+
+        frame_size = self.src_dtype.itemsize * self.src_channels
+        usable = len(data) - len(data) % frame_size
+        self.carry = data[usable:]
+
+        return np.frombuffer(data, dtype=self.src_dtype, count=usable // self.src_dtype.itemsize).reshape(-1, self.src_channels)
+
+    def resample(self, frames):
+        if self.src_rate == self.dst_rate or len(frames) == 0:
+            return frames
+
+        # Interpolating between blocks needs the last frame of the one before
+        if self.last is not None:
+            frames = np.concatenate((self.last, frames))
+            offset = 1
+        else:
+            offset = 0
+
+        step = self.src_rate / self.dst_rate
+
+        positions = np.arange(self.position + offset, len(frames) - 1, step)
+        self.position = (positions[-1] + step if len(positions) > 0 else self.position + offset) - len(frames)
+        self.last = frames[-1:]
+
+        index = positions.astype(np.intp)
+        frac = (positions - index)[:, None].astype(np.float32)
+
+        return frames[index] * (1 - frac) + frames[index + 1] * frac
+
+    def convert(self, block):
+        frames = self.to_float(self.frames(block))
+
+        if self.matrix is not None:
+            frames = frames @ self.matrix
+
+        frames = self.resample(frames)
+
+        if self.gain != 1.0:
+            frames = frames * self.gain
+
+        return np.ascontiguousarray(self.from_float(frames))
+
+    def stream(self, source, block_size=None):
+        # With a block size, output is regrouped into blocks of exactly that many bytes, except the last
+        if block_size is None:
+            for block in source:
+                out = self.convert(block)
+                if out.size > 0:
+                    yield out
+
+            return
+
+        frame_size = self.dst_dtype.itemsize * self.dst_channels
+        block_frames = block_size // frame_size
+
+        pending = np.empty((block_frames, self.dst_channels), dtype=self.dst_dtype)
+        filled = 0
+
+        for block in source:
+            out = self.convert(block)
+
+            while len(out) > 0:
+                to_copy = min(block_frames - filled, len(out))
+                pending[filled:filled + to_copy] = out[:to_copy]
+                out = out[to_copy:]
+                filled += to_copy
+
+                if filled == block_frames:
+                    yield pending
+
+                    pending = np.empty_like(pending)
+                    filled = 0
+
+        if filled > 0:
+            yield pending[:filled]
@@ -1,5 +1,7 @@
+import importlib
+
 from ..commands import *
-from ..types import ServiceStruct, HosVersion
+from ..types import ServiceStruct, HosVersion, Priority
 
 class Service:
     name = None
@@ -7,6 +9,8 @@ class Service:
 
     version = HosVersion(0,0,0)
 
+    priority = Priority.Normal
+
     @classmethod
     def set_hos_version(cls, setsys):
         cls.version = setsys.get_version().hos_version
@@ -36,24 +40,51 @@ class Service:
             #print("BLAH3")
         #print("BLAH4")
 
+    def execute(self, *args, priority=None, **kwargs):
+        if priority is None:
+            priority = self.priority
+
+        return self.h.execute(*args, priority=priority, **kwargs)
+
     def dispatch(self, *args, **kwargs):
-        out = self.h.execute(DispatchToService, self.base, *args, **kwargs)
+        out = self.execute(DispatchToService, self.base, *args, **kwargs)
 
         out["objects"] = [Service(self.h, x) for x in out["objects"]]
 
         return out
 
     def allocate(self, *args, **kwargs):
-        return self.h.execute(Allocate, *args, **kwargs)
+        return self.execute(Allocate, *args, **kwargs)
 
     def free(self, *args, **kwargs):
-        self.h.execute(Free, *args, **kwargs)
+        self.execute(Free, *args, **kwargs)
 
-    def read(self, *args, **kwargs):
-        return self.h.execute(Read, *args, **kwargs)
+    def read(self, ptr, size_or_type, **kwargs):
+        if not isinstance(size_or_type, int) or size_or_type <= self.h.frame_size:
+            return self.execute(Read, ptr, size_or_type, **kwargs)
 
-    def write(self, *args, **kwargs):
-        self.h.execute(Write, *args, **kwargs)
+        if not isinstance(ptr, int):
+            ptr = ptr.value
+
+        # Split up so other commands can get in between
+        return b"".join(
+            self.execute(Read, ptr + offset, min(size_or_type - offset, self.h.frame_size), **kwargs)
+            for offset in range(0, size_or_type, self.h.frame_size)
+        )
+
+    def write(self, ptr, to_write, **kwargs):
+        view = memoryview(to_write)
+        if view.nbytes <= self.h.frame_size or not view.c_contiguous:
+            self.execute(Write, ptr, to_write, **kwargs)
+
+            return
+
+        if not isinstance(ptr, int):
+            ptr = ptr.value
+
+        view = view.cast("B")
+        for offset in range(0, view.nbytes, self.h.frame_size):
+            self.execute(Write, ptr + offset, view[offset:offset + self.h.frame_size], **kwargs)
 
     def __del__(self):
         self.close()
@@ -82,20 +113,40 @@ class SubService:
     def version(self):
         return self.srv.version
 
+    # Overridden with a plain attribute by subservices that differ from their parent
+    @property
+    def priority(self):
+        return self.parent.priority
+
+    def execute(self, *args, **kwargs):
+        kwargs.setdefault("priority", self.priority)
+
+        return self.srv.execute(*args, **kwargs)
+
     def dispatch(self, *args, **kwargs):
+        kwargs.setdefault("priority", self.priority)
+
         return self.srv.dispatch(*args, **kwargs)
 
     def allocate(self, *args, **kwargs):
+        kwargs.setdefault("priority", self.priority)
+
         return self.srv.allocate(*args, **kwargs)
 
     def free(self, *args, **kwargs):
+        kwargs.setdefault("priority", self.priority)
+
         self.srv.free(*args, **kwargs)
 
     def read(self, *args, **kwargs):
+        kwargs.setdefault("priority", self.priority)
+
         return self.srv.read(*args, **kwargs)
 
     def write(self, *args, **kwargs):
-        self.srv.wrtie(*args, **kwargs)
+        kwargs.setdefault("priority", self.priority)
+
+        self.srv.write(*args, **kwargs)
 
     def __del__(self):
         self.close()
@@ -106,7 +157,24 @@ class SubService:
     def __exit__(self, type, value, traceback):
         self.close()
 
-from .account import Account
-from .audio import AudOut
-from .fs import FspSrv
-from .set import SetSys
\ No newline at end of file
+# Service modules pull in heavy dependencies like pyfilesystem and PIL,
+# so they're only imported once something in them is used
+lazy = {
+    "Account": "account",
+    "AudOut":  "audio",
+    "FspSrv":  "fs",
+    "SetSys":  "set",
+}
+
+def __getattr__(name):
+    module = lazy.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(lazy))
@@ -3,6 +3,7 @@ from PIL import Image
 from ctypes import *
 
 from ..types import SfBufferAttr
+from ..cache import memoize
 from . import Service, SubService
 
 class Account(Service):
@@ -19,21 +20,88 @@ class Account(Service):
         def valid(self):
             return self.uid[0] != 0 or self.uid[1] != 0
 
+    class ProfileBase(LittleEndianStructure):
+        _fields_ = [
+            ("uid",                 c_uint64 * 2),
+            ("last_edit_timestamp", c_uint64),
+            ("nickname",            c_char * 0x20)
+        ]
+
+    class UserData(LittleEndianStructure):
+        _fields_ = [
+            ("unk_x0",                    c_uint32),
+            ("icon_id",                   c_uint32),
+            ("icon_background_color_id",  c_uint8),
+            ("unk_xd",                    c_uint8 * 7),
+            ("mii_id",                    c_uint8 * 0x10),
+            ("unk_x20",                   c_uint8 * 0x60)
+        ]
+
     class Profile(SubService):
+        def get(self):
+            out = self.dispatch(0, None, Account.ProfileBase,
+                buffers=(
+                    (Account.UserData, SfBufferAttr.FixedSize | SfBufferAttr.HipcPointer),
+                )
+            )
+
+            return out["out"], out["buffers"][0]
+
+        def get_base(self):
+            out = self.dispatch(1, None, Account.ProfileBase)
+
+            return out["out"]
+
         def get_image_size(self):
             out = self.dispatch(10, None, c_uint32)
 
             return out["out"].value
 
-        def get_image(self):
+        def load_image(self):
             out = self.dispatch(11, None, c_uint32,
                 buffers=(
                     (self.get_image_size(), SfBufferAttr.HipcMapAlias),
                 )
             )
 
-            return Image.open(io.BytesIO(out["buffers"][0]))
+            return bytes(out["buffers"][0][:out["out"].value])
+
+        def get_image(self):
+            return Account.decode_image(self.load_image())
+
+    class ProfileInfo:
+        def __init__(self, uid, base, user_data, image=None):
+            self.uid = uid
+            self.nickname = base.nickname.decode()
+            self.last_edit_timestamp = base.last_edit_timestamp
+            self.user_data = user_data
+            self.image = image
+
+    image_cache = None
+
+    def __init__(self, *args, **kwargs):
+        # Profiles kept open for the image cache, by uid
+        self.profiles = {}
+
+        super().__init__(*args, **kwargs)
+
+    def close(self):
+        for profile in self.profiles.values():
+            profile.close()
 
+        self.profiles.clear()
+
+        super().close()
+
+    @staticmethod
+    def decode_image(data):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+
+        return image
+
+    # Users can be added or removed from the console while we're connected
+    @memoize(ttl=5)
     def list_all_users(self):
         out = self.dispatch(2,
             buffers=((self.Uid * self.user_list_size, SfBufferAttr.HipcPointer),)
@@ -46,4 +114,59 @@ class Account(Service):
             out_num_objects=1,
         )
 
-        return self.Profile(self, out["objects"][0])
\ No newline at end of file
+        return self.Profile(self, out["objects"][0])
+
+    def get_profile_image(self, uid):
+        if self.image_cache is None:
+            with self.get_profile(uid) as profile:
+                return profile.get_image()
+
+        # With the profile kept open, an image that hasn't changed only costs a GetBase
+        profile = self.open_profile(uid)
+
+        return self.cached_image(uid, profile, profile.get_base())
+
+    def open_profile(self, uid):
+        key = (uid.uid[0], uid.uid[1])
+
+        profile = self.profiles.get(key)
+        if profile is None or profile.closed:
+            profile = self.profiles[key] = self.get_profile(uid)
+
+        return profile
+
+    def cached_image(self, uid, profile, base):
+        if self.image_cache is None:
+            return profile.get_image()
+
+        name = f"{uid.uid[0]:016x}{uid.uid[1]:016x}"
+
+        image = self.image_cache.get(name, base.last_edit_timestamp, self.decode_image)
+        if image is None:
+            image = self.image_cache.put(name, base.last_edit_timestamp, profile.load_image(), self.decode_image)
+
+        return image
+
+    def fetch_all_profiles(self, images=False, keep_open=True):
+        # Every command is a round trip, so the most that can be saved is opening and closing
+        # sessions. Kept open, each user after the first call costs only a Get, plus an image
+        # download if it changed and there's an image cache.
+        profiles = []
+
+        for uid in self.list_all_users():
+            profile = self.open_profile(uid)
+
+            try:
+                base, user_data = profile.get()
+
+                image = None
+                if images:
+                    image = self.cached_image(uid, profile, base)
+            finally:
+                if not keep_open:
+                    self.profiles.pop((uid.uid[0], uid.uid[1]), None)
+                    profile.close()
+
+            profiles.append(self.ProfileInfo(uid, base, user_data, image))
+
+        return profiles
@@ -1,14 +1,26 @@
+import time
+import enum
+import threading
 from ctypes import *
 
-from ..types import SfBufferAttr
+from .. import util
+from ..cache import memoize
+from ..types import SfBufferAttr, Priority
 from ..constants import curr_proc_handle
 from . import Service, SubService
 
 class AudOut(Service):
     name = b"audout:u"
 
+    # Buffers have to be appended before the current ones run out
+    priority = Priority.High
+
     DeviceNameType = c_char * 0x100
 
+    class State(enum.Enum):
+        Started = 0
+        Stopped = 1
+
     class Buffer(LittleEndianStructure):
         _fields_ = [
             ("next",        c_void_p),
@@ -19,13 +31,261 @@ class AudOut(Service):
         ]
 
     class AudioOut(SubService):
+        class Stream:
+            buffer_count  = 4
+            buffer_size   = 0x6000
+            poll_interval = 0.005
+
+            def __init__(self, audio_out, source, buffer_count=None, buffer_size=None):
+                if buffer_count is not None:
+                    self.buffer_count = buffer_count
+
+                if buffer_size is not None:
+                    self.buffer_size = buffer_size
+
+                self.audio_out = audio_out
+                self.source = iter(source)
+                self.pending = bytearray()
+                self.exhausted = False
+                self.started = False
+
+                # The only console memory used, no matter how long the source is
+                self.buffers = [
+                    audio_out.allocate("memalign", self.buffer_size, 0x1000).value
+                    for i in range(self.buffer_count)
+                ]
+
+                self.free = list(self.buffers)
+
+                # When each buffer was handed to the console, and how long they took to come back
+                self.queued = {}
+                self.latencies = []
+
+                self.stopping = threading.Event()
+                self.finished = threading.Event()
+                self.error = None
+
+                self.feeder = threading.Thread(target=self.feed, daemon=True)
+
+            def next_chunk(self):
+                # Sources can hand out blocks of any size, so regroup them into buffer-sized ones
+                while len(self.pending) < self.buffer_size and not self.exhausted:
+                    try:
+                        block = util.byte_view(next(self.source))
+                    except StopIteration:
+                        self.exhausted = True
+
+                        break
+
+                    # Blocks that are already buffer-sized, like those from pcm.Converter.stream, go out as they are
+                    if len(self.pending) == 0 and block.nbytes == self.buffer_size:
+                        return block
+
+                    self.pending += block
+
+                chunk = self.pending[:self.buffer_size]
+                del self.pending[:self.buffer_size]
+
+                return chunk
+
+            def fill(self, ptr):
+                chunk = self.next_chunk()
+                if len(chunk) == 0:
+                    return False
+
+                self.queued[ptr] = time.monotonic()
+
+                self.audio_out.write(c_void_p(ptr), chunk)
+                self.audio_out.append_buffer(AudOut.Buffer(
+                    buffer=ptr,
+                    buffer_size=self.buffer_size,
+                    data_size=len(chunk)
+                ), ptr)
+
+                return True
+
+            def feed(self):
+                try:
+                    while not self.stopping.is_set():
+                        if len(self.free) < len(self.buffers):
+                            released = self.audio_out.get_released_buffers(len(self.buffers))
+
+                            now = time.monotonic()
+                            for ptr in released:
+                                self.latencies.append(now - self.queued.pop(ptr, now))
+
+                            self.free += released
+
+                        while len(self.free) > 0 and self.fill(self.free[-1]):
+                            self.free.pop()
+
+                            # Playback starts as soon as there's anything to play
+                            if not self.started:
+                                self.audio_out.start()
+                                self.started = True
+
+                        if self.exhausted and len(self.pending) == 0 and len(self.free) == len(self.buffers):
+                            break
+
+                        self.stopping.wait(self.poll_interval)
+                except Exception as e:
+                    self.error = e
+
+                self.finished.set()
+
+            def start(self):
+                self.feeder.start()
+
+                return self
+
+            def wait(self, timeout=None):
+                self.finished.wait(timeout)
+
+                if self.error is not None:
+                    raise self.error
+
+            def close(self):
+                self.stopping.set()
+
+                if self.feeder.is_alive():
+                    self.feeder.join()
+
+                if self.started:
+                    self.audio_out.stop()
+                    self.started = False
+
+                for ptr in self.buffers:
+                    self.audio_out.free(c_void_p(ptr))
+
+                self.buffers = []
+
+            def __enter__(self):
+                return self.start()
+
+            def __exit__(self, type, value, traceback):
+                self.close()
+
+            @property
+            def drained(self):
+                return self.exhausted and len(self.pending) == 0 and len(self.queued) == 0
+
+        class Monitor:
+            interval = 0.01
+
+            class Sample:
+                def __init__(self, time, state, depth, played):
+                    self.time = time
+                    self.state = state
+                    self.depth = depth
+                    self.played = played
+
+            def __init__(self, audio_out, stream=None, interval=None):
+                if interval is not None:
+                    self.interval = interval
+
+                self.audio_out = audio_out
+                self.stream = stream
+
+                # Queue depth and played samples can only be asked for on 4.0.0+,
+                # before that samples leave them as None and underruns can't be seen
+                self.has_counts = audio_out.version >= (4,0,0)
+
+                self.samples = []
+                self.underruns = []
+
+                self.stopping = threading.Event()
+                self.error = None
+
+                self.sampler = threading.Thread(target=self.run, daemon=True)
+
+            def sample(self):
+                if self.has_counts:
+                    depth = self.audio_out.get_buffer_count()
+                    played = self.audio_out.get_played_sample_count()
+                else:
+                    depth = None
+                    played = None
+
+                sample = self.Sample(time.monotonic(), self.audio_out.get_state(), depth, played)
+
+                # The queue running dry is only an underrun if there was more to play
+                starved = sample.state == AudOut.State.Started and sample.depth == 0
+                if starved and (self.stream is None or not self.stream.drained):
+                    if len(self.samples) == 0 or self.samples[-1].depth != 0:
+                        self.underruns.append(sample.time)
+
+                self.samples.append(sample)
+
+                return sample
+
+            def run(self):
+                try:
+                    while not self.stopping.is_set():
+                        self.sample()
+                        self.stopping.wait(self.interval)
+                except Exception as e:
+                    self.error = e
+
+            def start(self):
+                self.sampler.start()
+
+                return self
+
+            def stop(self):
+                self.stopping.set()
+
+                if self.sampler.is_alive():
+                    self.sampler.join()
+
+                if self.error is not None:
+                    raise self.error
+
+            def __enter__(self):
+                return self.start()
+
+            def __exit__(self, type, value, traceback):
+                self.stop()
+
+            @property
+            def stats(self):
+                stats = {
+                    "samples":   len(self.samples),
+                    "underruns": len(self.underruns),
+                }
+
+                if self.has_counts:
+                    depths = [x.depth for x in self.samples]
+
+                    stats.update({
+                        "min_depth": min(depths, default=0),
+                        "max_depth": max(depths, default=0),
+                        "avg_depth": sum(depths) / len(depths) if len(depths) > 0 else 0,
+                        "played":    self.samples[-1].played if len(self.samples) > 0 else 0,
+                    })
+
+                if self.stream is not None and len(self.stream.latencies) > 0:
+                    latencies = self.stream.latencies
+
+                    stats.update({
+                        "min_latency": min(latencies),
+                        "max_latency": max(latencies),
+                        "avg_latency": sum(latencies) / len(latencies),
+                    })
+
+                return stats
+
+        def get_state(self):
+            out = self.dispatch(0, None, c_uint32)
+
+            return AudOut.State(out["out"].value)
+
         def start(self):
             self.dispatch(1)
 
         def stop(self):
             self.dispatch(2)
 
-        def append_buffer(self, buffer):
+        def append_buffer(self, buffer, tag=0):
             if self.version >= (3,0,0):
                 cmd_id = 7
                 attr = SfBufferAttr.HipcAutoSelect
@@ -33,12 +293,56 @@ class AudOut(Service):
                 cmd_id = 3
                 attr = SfBufferAttr.HipcMapAlias
 
-            out = self.dispatch(cmd_id, c_uint64(),
+            out = self.dispatch(cmd_id, c_uint64(tag),
                 buffers=(
                     (buffer, attr),
                 )
             )
 
+        def get_released_buffers(self, count):
+            if self.version >= (3,0,0):
+                cmd_id = 8
+                attr = SfBufferAttr.HipcAutoSelect
+            else:
+                cmd_id = 5
+                attr = SfBufferAttr.HipcMapAlias
+
+            out = self.dispatch(cmd_id, None, c_uint32,
+                buffers=(
+                    (c_uint64 * count, attr),
+                )
+            )
+
+            return list(out["buffers"][0][:out["out"].value])
+
+        def contains_buffer(self, tag):
+            out = self.dispatch(6, c_uint64(tag), c_bool)
+
+            return out["out"].value
+
+        def get_buffer_count(self):
+            if self.version < (4,0,0):
+                raise ValueError("Version too low")
+
+            out = self.dispatch(9, None, c_uint32)
+
+            return out["out"].value
+
+        def get_played_sample_count(self):
+            if self.version < (4,0,0):
+                raise ValueError("Version too low")
+
+            out = self.dispatch(10, None, c_uint64)
+
+            return out["out"].value
+
+        def stream(self, source, buffer_count=None, buffer_size=None):
+            return self.Stream(self, source, buffer_count, buffer_size)
+
+        def monitor(self, stream=None, interval=None):
+            return self.Monitor(self, stream, interval)
+
+    @memoize()
     def list_audio_outs(self, count):
         if self.version >= (3,0,0):
             cmd_id = 2
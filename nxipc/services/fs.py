@@ -1,12 +1,19 @@
 import io
+import os
 import stat
 import enum
-import fs, fs.base, fs.subfs
+import fs, fs.base, fs.subfs, fs.walk, fs.tree, fs.path
+import functools
+import itertools
+import contextlib
 import datetime as dt
+import concurrent.futures
 from ctypes import *
 
 from .. import util
-from ..types import SfBufferAttr, ResultException
+from ..cache import memoize
+from ..types import SfBufferAttr, ResultException, Priority, CompactBuffer
+from ..commands import WalkTree, UnpackFiles, PackFiles
 from . import Service, SubService
 
 class FspSrv(Service):
@@ -44,16 +51,92 @@ class FspSrv(Service):
 
         PathType = c_char * 0x301
 
+        # Paths are looked up over and over, so keep their encoded forms around
+        @staticmethod
+        @functools.lru_cache(maxsize=0x400)
+        def path_buffer(path):
+            return CompactBuffer(path.encode(), sizeof(FspSrv.FileSystem.PathType))
+
         class File(SubService, io.IOBase):
-            def __init__(self, mode, *args, **kwargs):
+            write_buffer_size   = 0x40000
+            write_alignment     = 0x1000
+            transfer_chunk_size = 0x100000
+
+            handle_cache = None
+            cache_ticket = None
+
+            priority = Priority.Bulk
+
+            class In(LittleEndianStructure):
+                _fields_ = [
+                    ("option", c_uint32),
+                    ("pad",    c_uint32),
+                    ("offset", c_int64),
+                    ("size",   c_uint64)
+                ]
+
+            def __init__(self, mode, *args, path=None, **kwargs):
                 super().__init__(*args, **kwargs)
 
-                if "a" in mode:
+                self.path = path
+
+                self.pending = bytearray()
+                self.pending_offset = 0
+
+                self.mode = mode
+
+                self.rewind()
+
+            def rewind(self):
+                if "a" in self.mode:
                     self.pos = self.size()
                 else:
                     self.pos = 0
 
-                self.mode = mode
+            @property
+            def closed(self):
+                # Detached from its session once that went back to the pool
+                return self.srv is None or super().closed
+
+            def check_open(self):
+                if self.closed:
+                    raise ValueError("I/O operation on closed file")
+
+            def close(self):
+                if not self.closed:
+                    self.flush_pending(True)
+
+                    # Cached sessions go back to the parent's pool instead of being closed,
+                    # and whoever opens the path next gets a File of their own around it
+                    cache = self.handle_cache
+                    if cache is not None:
+                        srv = self.srv
+
+                        self.srv = None
+                        self.handle_cache = None
+
+                        if not cache.release(self.cache_ticket, srv):
+                            srv.close()
+
+                        return
+
+                    SubService.close(self)
+
+            def dispatch(self, *args, **kwargs):
+                self.check_open()
+
+                return super().dispatch(*args, **kwargs)
+
+            @property
+            def block_cache(self):
+                if self.path is None:
+                    return None
+
+                return self.parent.block_cache
+
+            def invalidate_cache(self):
+                if self.path is not None:
+                    self.parent.invalidate_cache(self.path, handles=False)
 
             def seekable(self):
                 return True
@@ -65,6 +148,9 @@ class FspSrv(Service):
                 return "w" in self.mode or "a" in self.mode
 
             def read(self, size=-1, offset=None, option=0):
+                self.check_open()
+                self.flush_pending()
+
                 if offset is None:
                     offset = self.tell()
                 else:
@@ -73,63 +159,280 @@ class FspSrv(Service):
                 if size < 0:
                     size = self.size() - offset
 
-                class In(LittleEndianStructure):
-                    _fields_ = [
-                        ("option", c_uint32),
-                        ("pad",    c_uint32),
-                        ("offset", c_int64),
-                        ("size",   c_uint64)
-                    ]
+                if self.block_cache is not None and option == 0:
+                    data = self.read_cached(size, offset)
+                else:
+                    data = self.read_raw(size, offset, option)
 
-                out = self.dispatch(0, In(option, 0, offset, size), c_uint64,
-                    buffers=(
-                        (size, SfBufferAttr.HipcMapAlias | SfBufferAttr.HipcMapTransferAllowsNonSecure),
+                self.seek(len(data), os.SEEK_CUR)
+
+                return data
+
+            @property
+            def frame_size(self):
+                return self.srv.h.frame_size
+
+            def read_raw(self, size, offset, option=0):
+                # Large reads are split into frames so other commands can get in between
+                chunks = []
+                for frame_offset in range(offset, offset + size, self.frame_size):
+                    frame_size = min(offset + size - frame_offset, self.frame_size)
+
+                    out = self.dispatch(0, self.In(option, 0, frame_offset, frame_size), c_uint64,
+                        buffers=(
+                            (frame_size, SfBufferAttr.HipcMapAlias | SfBufferAttr.HipcMapTransferAllowsNonSecure),
+                        )
                     )
-                )
 
-                bytes_read = out["out"].value
-                self.seek(bytes_read, 1)
+                    chunks.append(memoryview(out["buffers"][0])[:out["out"].value])
+                    if out["out"].value < frame_size:
+                        break
 
-                return out["buffers"][0][:bytes_read]
+                return b"".join(chunks)
+
+            def read_cached(self, size, offset):
+                cache = self.block_cache
+                block_size = cache.block_size
+
+                chunks = []
+                end = offset + size
+                index = offset // block_size
+
+                while offset < end:
+                    block = cache.get(self.parent, self.path, index)
+                    if block is None:
+                        block = self.read_raw(block_size, index * block_size)
+                        cache.put(self.parent, self.path, index, block)
+
+                    start = offset - index * block_size
+                    chunk = memoryview(block)[start:start + end - offset]
+                    chunks.append(chunk)
+
+                    # A short block means we hit the end of the file
+                    if len(block) < block_size:
+                        break
+
+                    offset += len(chunk)
+                    index += 1
+
+                return b"".join(chunks)
+
+            def readinto(self, b, offset=None, option=0):
+                self.check_open()
+                self.flush_pending()
 
-            def write(self, b, offset=None, flush=False):
                 if offset is None:
                     offset = self.tell()
                 else:
                     self.seek(offset)
 
+                view = memoryview(b).cast("B")
+
+                if self.block_cache is not None and option == 0:
+                    data = self.read_cached(view.nbytes, offset)
+                    view[:len(data)] = data
+
+                    self.seek(len(data), os.SEEK_CUR)
+
+                    return len(data)
+
+                bytes_read = 0
+                for start in range(0, view.nbytes, self.frame_size):
+                    frame = view[start:start + self.frame_size]
+
+                    out = self.dispatch(0, self.In(option, 0, offset + start, frame.nbytes), c_uint64,
+                        buffers=(
+                            (frame, SfBufferAttr.HipcMapAlias | SfBufferAttr.HipcMapTransferAllowsNonSecure | SfBufferAttr.Out),
+                        )
+                    )
+
+                    bytes_read += out["out"].value
+                    if out["out"].value < frame.nbytes:
+                        break
+
+                self.seek(bytes_read, os.SEEK_CUR)
+
+                return bytes_read
+
+            def read_to(self, dst, offset=None, chunk_size=None, progress=None):
+                if isinstance(dst, (str, os.PathLike)):
+                    with open(dst, "wb") as f:
+                        return self.read_to(f, offset, chunk_size, progress)
+
+                if chunk_size is None:
+                    chunk_size = self.transfer_chunk_size
+
+                if offset is not None:
+                    self.seek(offset)
+
+                stats = util.TransferStats(self.size() - self.tell())
+
+                # Write the previous chunk to the host while the next one is being received
+                buffers = (bytearray(chunk_size), bytearray(chunk_size))
+                with concurrent.futures.ThreadPoolExecutor(1) as writer:
+                    current = 0
+                    last_write = None
+
+                    while True:
+                        size = self.readinto(buffers[current])
+
+                        if last_write is not None:
+                            last_write.result()
+                            last_write = None
+
+                        if size == 0:
+                            break
+
+                        last_write = writer.submit(dst.write, memoryview(buffers[current])[:size])
+
+                        stats.add(size)
+                        if progress is not None:
+                            progress(stats)
+
+                        if size < chunk_size:
+                            break
+
+                        current ^= 1
+
+                    if last_write is not None:
+                        last_write.result()
+
+                stats.finish()
+
+                return stats
+
+            def write_raw(self, b, offset, flush=False):
                 if flush:
                     option = 1
                 else:
                     option = 0
 
+                self.invalidate_cache()
+
+                view = memoryview(b).cast("B")
+                for start in range(0, max(view.nbytes, 1), self.frame_size):
+                    frame = view[start:start + self.frame_size]
+
+                    # Only the last frame needs flushing
+                    if start + self.frame_size < view.nbytes:
+                        frame_option = 0
+                    else:
+                        frame_option = option
+
+                    self.dispatch(1, self.In(frame_option, 0, offset + start, frame.nbytes),
+                        buffers=(
+                            (frame, SfBufferAttr.HipcMapAlias | SfBufferAttr.HipcMapTransferAllowsNonSecure),
+                        )
+                    )
+
+            def flush_pending(self, flush=False):
+                if len(self.pending) == 0:
+                    return False
+
+                self.write_raw(self.pending, self.pending_offset, flush)
+
+                self.pending_offset += len(self.pending)
+                self.pending = bytearray()
+
+                return True
+
+            def write(self, b, offset=None, flush=False):
+                self.check_open()
+
+                if offset is not None:
+                    self.seek(offset)
+
                 if isinstance(b, str):
                     b = b.encode()
 
                 size = len(b)
 
-                class In(LittleEndianStructure):
-                    _fields_ = [
-                        ("option", c_uint32),
-                        ("pad",    c_uint32),
-                        ("offset", c_int64),
-                        ("size",   c_uint64)
-                    ]
+                if self.pending_offset + len(self.pending) != self.pos:
+                    self.flush_pending()
 
-                out = self.dispatch(1, In(option, 0, offset, size),
-                    buffers=(
-                        (b, SfBufferAttr.HipcMapAlias | SfBufferAttr.HipcMapTransferAllowsNonSecure),
-                    )
-                )
+                if len(self.pending) == 0:
+                    self.pending_offset = self.pos
+
+                    # Big writes gain nothing from coalescing
+                    if size >= self.write_buffer_size:
+                        self.write_raw(b, self.pos, flush)
+                        self.pos += size
+
+                        return size
+
+                self.pending += b
+                self.pos += size
 
-                self.seek(size, 1)
+                if flush:
+                    self.flush()
+                elif len(self.pending) >= self.write_buffer_size:
+                    # Only send up to an aligned boundary, the rest
+                    # will most likely be joined by the next writes
+                    end = self.pending_offset + len(self.pending)
+                    end -= end % self.write_alignment
+
+                    to_write = end - self.pending_offset
+                    if to_write > 0:
+                        self.write_raw(self.pending[:to_write], self.pending_offset)
+
+                        del self.pending[:to_write]
+                        self.pending_offset = end
 
                 return size
 
+            def write_from(self, src, offset=None, chunk_size=None, progress=None):
+                if isinstance(src, (str, os.PathLike)):
+                    with open(src, "rb") as f:
+                        return self.write_from(f, offset, chunk_size, progress)
+
+                if chunk_size is None:
+                    chunk_size = self.transfer_chunk_size
+
+                if offset is not None:
+                    self.seek(offset)
+
+                self.flush_pending()
+
+                try:
+                    total = os.fstat(src.fileno()).st_size - src.tell()
+                except (AttributeError, OSError, io.UnsupportedOperation):
+                    total = None
+
+                stats = util.TransferStats(total)
+
+                # Read the next chunk from the host while the current one is being sent
+                buffers = (bytearray(chunk_size), bytearray(chunk_size))
+                with concurrent.futures.ThreadPoolExecutor(1) as reader:
+                    current = 0
+                    size = src.readinto(buffers[current]) or 0
+
+                    while size > 0:
+                        next_read = reader.submit(src.readinto, buffers[current ^ 1])
+
+                        self.write_raw(memoryview(buffers[current])[:size], self.pos)
+                        self.pos += size
+
+                        stats.add(size)
+                        if progress is not None:
+                            progress(stats)
+
+                        size = next_read.result() or 0
+                        current ^= 1
+
+                self.flush()
+                stats.finish()
+
+                return stats
+
             def flush(self):
-                self.dispatch(2)
+                if not self.flush_pending(True):
+                    self.dispatch(2)
 
             def set_size(self, size):
+                self.flush_pending()
+
+                self.invalidate_cache()
+
                 self.dispatch(3, c_int64(size))
 
             def truncate(self, pos=None):
@@ -141,21 +444,38 @@ class FspSrv(Service):
                 return pos
 
             def size(self):
+                self.flush_pending()
+
                 out = self.dispatch(4, None, c_int64)
 
                 return out["out"].value
 
-            def seek(self, pos, whence=0):
-                if whence == 0:
-                    self.pos = pos
-                elif whence == 1:
-                    self.pos += pos
-                elif whence == 2:
-                    self.pos = self.size() + pos
+            def seek(self, pos, whence=os.SEEK_SET):
+                if whence == os.SEEK_SET:
+                    new_pos = pos
+                elif whence == os.SEEK_CUR:
+                    new_pos = self.pos + pos
+                elif whence == os.SEEK_END:
+                    new_pos = self.size() + pos
+                else:
+                    raise ValueError(f"Invalid whence ({whence})")
+
+                if new_pos < 0:
+                    raise ValueError(f"Negative seek position {new_pos}")
+
+                if new_pos != self.pos:
+                    self.flush_pending()
+
+                self.pos = new_pos
 
                 return self.pos
 
         class Directory(SubService):
+            page_size = 0x40
+
+            # Arrays don't cost anything per entry, so read them in much bigger pages
+            array_page_size = 0x400
+
             class Entry(LittleEndianStructure):
                 _fields_ = [
                     ("raw_name", c_char * 0x301),
@@ -173,42 +493,186 @@ class FspSrv(Service):
                 def name(self):
                     return self.raw_name.decode()
 
-            def read(self, max_entries=None):
-                if max_entries is None:
-                    max_entries = self.entry_count()
+            @classmethod
+            @functools.lru_cache(None)
+            def entry_dtype(cls):
+                import numpy as np
 
-                if max_entries == 0:
-                    return []
+                # Matches Entry, leaving out the padding
+                return np.dtype({
+                    "names":    ["name", "type", "size"],
+                    "formats":  ["S769", "i1",   "<i8"],
+                    "offsets":  [0x0,    0x304,  0x308],
+                    "itemsize": sizeof(cls.Entry),
+                })
+
+            @staticmethod
+            def entry_names(entries):
+                import numpy as np
 
+                return np.char.decode(entries["name"], "utf-8")
+
+            def read_buffer(self, max_entries):
                 out = self.dispatch(0, None, c_int64,
                     buffers=(
                         (self.Entry * max_entries, SfBufferAttr.HipcMapAlias),
                     )
                 )
 
-                return list(out["buffers"][0][:out["out"].value])
+                return out["buffers"][0], out["out"].value
+
+            def read(self, max_entries=None):
+                if max_entries is None:
+                    max_entries = self.entry_count()
+
+                if max_entries == 0:
+                    return []
+
+                buffer, count = self.read_buffer(max_entries)
+
+                return list(buffer[:count])
+
+            def read_array(self, max_entries=None):
+                import numpy as np
+
+                if max_entries is None:
+                    max_entries = self.entry_count()
+
+                if max_entries == 0:
+                    return np.empty(0, dtype=self.entry_dtype())
+
+                # A view of the out buffer itself, without an object for each entry
+                buffer, count = self.read_buffer(max_entries)
+
+                return np.frombuffer(buffer, dtype=self.entry_dtype(), count=count)
+
+            def read_all_array(self, page_size=None):
+                import numpy as np
+
+                if page_size is None:
+                    page_size = self.array_page_size
+
+                # Out buffers come back whole, however few entries are in them, so don't ask for more than are left
+                pages = []
+                remaining = self.entry_count()
+                while remaining > 0:
+                    page = self.read_array(min(remaining, page_size))
+                    if len(page) == 0:
+                        break
+
+                    pages.append(page)
+                    remaining -= len(page)
+
+                if len(pages) == 0:
+                    return np.empty(0, dtype=self.entry_dtype())
+
+                if len(pages) == 1:
+                    return pages[0]
+
+                return np.concatenate(pages)
+
+            def iter_entries(self, page_size=None):
+                if page_size is None:
+                    page_size = self.page_size
+
+                while True:
+                    entries = self.read(page_size)
+
+                    yield from entries
+
+                    if len(entries) < page_size:
+                        break
 
             def entry_count(self):
                 out = self.dispatch(1, None, c_int64)
 
                 return out["out"].value
 
+        class Walker(fs.walk.Walker):
+            listing = None
+
+            @classmethod
+            def bind(cls, filesystem):
+                return fs.walk.BoundWalker(filesystem, cls)
+
+            def _scan(self, filesystem, dir_path, namespaces=None):
+                # Sub-filesystems, like what opendir returns, are walked through the filesystem they wrap
+                target, target_path = filesystem, dir_path
+                while not hasattr(target, "walk_listing") and hasattr(target, "delegate_path"):
+                    target, target_path = target.delegate_path(target_path)
+
+                if not hasattr(target, "walk_listing"):
+                    yield from super()._scan(filesystem, dir_path, namespaces)
+
+                    return
+
+                # The whole tree is listed by the console on the first scan
+                if self.listing is None:
+                    try:
+                        self.listing = target.walk_listing(target_path, self.max_depth)
+                    except fs.errors.FSError as error:
+                        if not self.on_error(dir_path, error):
+                            raise
+
+                        return
+
+                entries = self.listing.get(fs.path.abspath(fs.path.normpath(target_path)))
+                if entries is None:
+                    yield from super()._scan(filesystem, dir_path, namespaces)
+
+                    return
+
+                for name, is_dir, size in entries:
+                    yield target.make_info(fs.path.join(target_path, name), is_dir, size, namespaces)
+
+        walker_class = Walker
+
+        block_cache    = None
+        metadata_cache = None
+        handle_cache   = None
+        prefetched     = None
+
         def __init__(self, *args, **kwargs):
             SubService.__init__(self, *args, **kwargs)
             fs.base.FS.__init__(self)
 
         def close(self):
             if not self.closed:
+                self.invalidate_cache()
+
                 SubService.close(self)
                 fs.base.FS.close(self)
 
+        def invalidate_cache(self, *paths, recursive=False, handles=True):
+            if self.block_cache is not None:
+                if len(paths) == 0 or recursive:
+                    self.block_cache.invalidate(self)
+                else:
+                    for path in paths:
+                        self.block_cache.invalidate(self, path)
+
+            if self.metadata_cache is not None:
+                if len(paths) == 0:
+                    self.metadata_cache.invalidate()
+                else:
+                    for path in paths:
+                        self.metadata_cache.invalidate(path, recursive)
+
+            # Writing through a handle doesn't make other handles to the same file stale
+            if self.handle_cache is not None and handles:
+                if len(paths) == 0:
+                    self.handle_cache.invalidate()
+                else:
+                    for path in paths:
+                        self.handle_cache.invalidate(path, recursive)
+
         def __del__(self):
             self.close()
 
         def dispatch_paths(self, cmd_id, *paths):
             return self.dispatch(cmd_id,
                 buffers=tuple(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer)
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer)
                     for path in paths
                 )
             )
@@ -224,38 +688,73 @@ class FspSrv(Service):
             if big:
                 option |= util.bit(0)
 
+            self.invalidate_cache(path)
+
             self.dispatch(0, In(option, size),
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 )
             )
 
         def delete_file(self, path):
+            self.invalidate_cache(path)
+
             self.dispatch_paths(1, path)
 
         def create_dir(self, path):
+            self.invalidate_cache(path)
+
             self.dispatch_paths(2, path)
 
         def delete_dir(self, path, recursive=True):
+            self.invalidate_cache(path, recursive=True)
+
             if recursive:
                 self.dispatch_paths(4, path)
             else:
                 self.dispatch_paths(3, path)
 
         def rename_file(self, old, new):
+            self.invalidate_cache(old, new)
+
             self.dispatch_paths(5, old, new)
 
         def rename_dir(self, old, new):
+            self.invalidate_cache(old, new, recursive=True)
+
             self.dispatch_paths(6, old, new)
 
         def is_file(self, path):
+            if self.metadata_cache is not None:
+                is_file = self.metadata_cache.get(path, "is_file")
+                if is_file is not None:
+                    return is_file
+
             out = self.dispatch(7, None, c_uint32,
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 )
             )
 
-            return out["out"].value == 1
+            is_file = out["out"].value == 1
+            if self.metadata_cache is not None:
+                self.metadata_cache.update(path, is_file=is_file)
+
+            return is_file
+
+        def file_size(self, path):
+            if self.metadata_cache is not None:
+                size = self.metadata_cache.get(path, "size")
+                if size is not None:
+                    return size
+
+            with self.open_cached(path) as f:
+                size = f.size()
+
+            if self.metadata_cache is not None:
+                self.metadata_cache.update(path, size=size)
+
+            return size
 
         def open_file(self, path, mode="r"):
             real_mode = 0
@@ -267,12 +766,31 @@ class FspSrv(Service):
 
             out = self.dispatch(8, c_uint32(real_mode),
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 ),
                 out_num_objects=1
             )
 
-            return self.File(mode, self, out["objects"][0])
+            return self.File(mode, self, out["objects"][0], path=path)
+
+        def open_cached(self, path, mode="r"):
+            if self.handle_cache is None:
+                return self.open_file(path, mode)
+
+            srv, ticket = self.handle_cache.acquire((path, mode))
+            try:
+                if srv is None:
+                    f = self.open_file(path, mode)
+                else:
+                    f = self.File(mode, self, srv, path=path)
+            except:
+                self.handle_cache.discard(ticket)
+                raise
+
+            f.handle_cache = self.handle_cache
+            f.cache_ticket = ticket
+
+            return f
 
         def open_dir(self, path, mode=None):
             if mode is None:
@@ -280,7 +798,7 @@ class FspSrv(Service):
 
             out = self.dispatch(9, c_uint32(mode),
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 ),
                 out_num_objects=1
             )
@@ -288,21 +806,24 @@ class FspSrv(Service):
             return self.Directory(self, out["objects"][0])
 
         def commit(self):
+            self.invalidate_cache()
+
             self.dispatch(10)
 
         def free_space(self, path="/"):
             out = self.dispatch(11, None, c_int64,
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 )
             )
 
             return out["out"].value
 
+        @memoize()
         def total_space(self, path="/"):
             out = self.dispatch(12, None, c_int64,
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 )
             )
 
@@ -312,88 +833,236 @@ class FspSrv(Service):
             if self.version < (3,0,0):
                 raise ValueError("Version too low")
 
+            self.invalidate_cache(path, recursive=True)
+
             self.dispatch_paths(13, path)
 
         def get_file_timestamp(self, path):
             if self.version < (3,0,0):
                 raise ValueError("Version too low")
 
+            if self.metadata_cache is not None:
+                ts = self.metadata_cache.get(path, "timestamp")
+                if ts is not None:
+                    return ts
+
             out = self.dispatch(14, None, self.FileTimestamp,
                 buffers=(
-                    (self.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                    (self.path_buffer(path), SfBufferAttr.HipcPointer),
                 )
             )
 
+            if self.metadata_cache is not None:
+                self.metadata_cache.update(path, timestamp=out["out"])
+
             return out["out"]
 
-        # Essential FS methods
+        def walk_fast(self, path="/", max_depth=None, timestamps=False):
+            path = fs.path.abspath(fs.path.normpath(path))
 
-        def getinfo(self, path, namespaces=None):
+            try:
+                records = self.execute(WalkTree, self.srv.base, self.PathType(*path.encode()), max_depth or 0, timestamps)
+            except ResultException as e:
+                if e.result == 0x202:
+                    raise fs.errors.ResourceNotFound(path)
+
+                # Which result a file gives depends on the filesystem, so ask
+                try:
+                    is_file = self.is_file(path)
+                except ResultException:
+                    raise e
+
+                if is_file:
+                    raise fs.errors.DirectoryExpected(path)
+                else:
+                    raise e
+
+            ret = []
+            for name, type, size, modified in records:
+                entry_path = fs.path.join(path, name)
+                is_dir = type == 0
+
+                if self.metadata_cache is not None:
+                    self.metadata_cache.update(entry_path, is_file=not is_dir, size=size)
+
+                ret.append((entry_path, is_dir, size, modified))
+
+            return ret
+
+        def walk_listing(self, path="/", max_depth=None):
+            path = fs.path.abspath(fs.path.normpath(path))
+
+            listing = {path: []}
+            for entry_path, is_dir, size, _ in self.walk_fast(path, max_depth):
+                parent, name = fs.path.split(entry_path)
+                listing.setdefault(parent, []).append((name, is_dir, size))
+
+                # Directories past the maximum depth weren't listed, so can't be known to be empty
+                depth = entry_path[len(path):].strip("/").count("/") + 1
+                if is_dir and (max_depth is None or depth < max_depth):
+                    listing.setdefault(entry_path, [])
+
+            return listing
+
+        def download(self, path, dst, chunk_size=None, progress=None):
+            with self.openbin(path, "r") as f:
+                return f.read_to(dst, 0, chunk_size, progress)
+
+        def upload_many(self, files):
+            paths = []
+            items = []
+
+            with contextlib.ExitStack() as stack:
+                for path, src in files:
+                    path = fs.path.abspath(fs.path.normpath(path))
+
+                    if isinstance(src, (str, os.PathLike)):
+                        size = os.path.getsize(src)
+                        src = stack.enter_context(open(src, "rb"))
+                    elif hasattr(src, "readinto"):
+                        # Works for in-memory files too, which have no fileno
+                        start = src.tell()
+                        size = src.seek(0, io.SEEK_END) - start
+                        src.seek(start)
+                    else:
+                        size = memoryview(src).nbytes
+
+                    paths.append(path)
+                    items.append((path, size, src))
+
+                self.invalidate_cache(*paths)
+
+                results = self.execute(UnpackFiles, self.srv.base, items)
+
+            return list(zip(paths, results))
+
+        def download_many(self, paths):
+            paths = [fs.path.abspath(fs.path.normpath(x)) for x in paths]
+
+            # Otherwise a batch could never take it and would end up empty
+            for path in paths:
+                if len(path.encode()) + 1 > PackFiles.max_paths_size:
+                    raise ValueError(f"Path too long: {len(path.encode()):#x} bytes")
+
+            # Split into as few batches as the console's path buffer allows
+            files = []
+            while len(paths) > 0:
+                batch_size = 0
+                count = 0
+                for path in paths:
+                    batch_size += len(path.encode()) + 1
+                    if batch_size > PackFiles.max_paths_size:
+                        break
+
+                    count += 1
+
+                files += self.execute(PackFiles, self.srv.base, paths[:count])
+                paths = paths[count:]
+
+            return files
+
+        def upload(self, src, path, chunk_size=None, progress=None):
             if path[0] != "/":
                 path = "/" + path
 
+            if isinstance(src, (str, os.PathLike)):
+                with open(src, "rb") as f:
+                    return self.upload(f, path, chunk_size, progress)
+
+            try:
+                size = os.fstat(src.fileno()).st_size
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                size = 0
+
+            try:
+                try:
+                    self.delete_file(path)
+                except ResultException:
+                    pass
+
+                # Files of 4GiB or more need to be concatenation files on FAT32
+                self.create_file(path, big=size >= 0x100000000)
+
+                with self.open_file(path, "w") as f:
+                    return f.write_from(src, 0, chunk_size, progress)
+            except ResultException as e:
+                if e.result == 0x202:
+                    raise fs.errors.ResourceNotFound(path)
+                else:
+                    raise e
+
+        # Essential FS methods
+
+        def make_info(self, path, is_dir, size=None, namespaces=None):
             if namespaces is None:
                 namespaces = []
 
-            try:
-                raw_info = {
-                    "basic": {
-                        "name":   path.split("/")[-1],
-                        "is_dir": not self.is_file(path),
-                    },
-                }
-
-                if len(namespaces) > 0:
-                    if raw_info["basic"]["is_dir"]:
-                        type = fs.enums.ResourceType.directory
-                        ts = self.FileTimestamp()
-                        size = 0
-                    else:
-                        type = fs.enums.ResourceType.file
-                        ts = self.get_file_timestamp(path)
-
-                        with self.open_file(path) as f:
-                            size = f.size()
-
-                    for n in namespaces:
-                        if n == "details":
-                            raw_info["details"] = {
-                                "accessed":         dt.datetime.fromtimestamp(ts.accessed),
-                                "created":          dt.datetime.fromtimestamp(ts.created),
-                                "metadata_changed": None,
-                                "modified":         dt.datetime.fromtimestamp(ts.modified),
-                                "size":             size,
-                                "type":             type,
+            raw_info = {
+                "basic": {
+                    "name":   path.split("/")[-1],
+                    "is_dir": is_dir,
+                },
+            }
+
+            # Only go to the console for what the namespaces actually need
+            if "details" in namespaces or "stat" in namespaces:
+                if is_dir:
+                    type = fs.enums.ResourceType.directory
+                    ts = self.FileTimestamp()
+                    size = 0
+                else:
+                    type = fs.enums.ResourceType.file
+                    ts = self.get_file_timestamp(path)
+
+                    if size is None:
+                        size = self.file_size(path)
+
+                for n in namespaces:
+                    if n == "details":
+                        raw_info["details"] = {
+                            "accessed":         dt.datetime.fromtimestamp(ts.accessed),
+                            "created":          dt.datetime.fromtimestamp(ts.created),
+                            "metadata_changed": None,
+                            "modified":         dt.datetime.fromtimestamp(ts.modified),
+                            "size":             size,
+                            "type":             type,
+                        }
+                    elif n == "stat":
+                        if is_dir:
+                            raw_info["stat"] = {
+                                "st_mode":  stat.S_IFDIR | stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO,
+                                "st_ino":   0,
+                                "st_dev":   0,
+                                "st_nlink": 1,
+                                "st_uid":   0,
+                                "st_gid":   0,
+                                "st_size":  0,
+                                "st_atime": 0,
+                                "st_mtime": 0,
+                                "st_ctime": 0,
                             }
-                        elif n == "stat":
-                            if raw_info["basic"]["is_dir"]:
-                                raw_info["stat"] = {
-                                    "st_mode":  stat.S_IFDIR | stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO,
-                                    "st_ino":   0,
-                                    "st_dev":   0,
-                                    "st_nlink": 1,
-                                    "st_uid":   0,
-                                    "st_gid":   0,
-                                    "st_size":  0,
-                                    "st_atime": 0,
-                                    "st_mtime": 0,
-                                    "st_ctime": 0,
-                                }
-                            else:
-                                raw_info["stat"] = {
-                                    "st_mode":  stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWOTH,
-                                    "st_ino":   0,
-                                    "st_dev":   0,
-                                    "st_nlink": 1,
-                                    "st_uid":   0,
-                                    "st_gid":   0,
-                                    "st_size":  size,
-                                    "st_atime": ts.accessed,
-                                    "st_mtime": ts.modified,
-                                    "st_ctime": ts.created,
-                                }
-
-                return fs.info.Info(raw_info)
+                        else:
+                            raw_info["stat"] = {
+                                "st_mode":  stat.S_IFREG | stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWOTH,
+                                "st_ino":   0,
+                                "st_dev":   0,
+                                "st_nlink": 1,
+                                "st_uid":   0,
+                                "st_gid":   0,
+                                "st_size":  size,
+                                "st_atime": ts.accessed,
+                                "st_mtime": ts.modified,
+                                "st_ctime": ts.created,
+                            }
+
+            return fs.info.Info(raw_info)
+
+        def getinfo(self, path, namespaces=None):
+            if path[0] != "/":
+                path = "/" + path
+
+            try:
+                return self.make_info(path, not self.is_file(path), namespaces=namespaces)
             except ResultException as e:
                 if e.result == 0x202:
                     raise fs.errors.ResourceNotFound(path)
@@ -401,6 +1070,9 @@ class FspSrv(Service):
                     raise e
 
         def listdir(self, path):
+            return [x.name for x in self.iter_entries(path)]
+
+        def iter_entries(self, path, page_size=None):
             if path[0] != "/":
                 path = "/" + path
 
@@ -408,10 +1080,44 @@ class FspSrv(Service):
                 if self.is_file(path):
                     raise fs.errors.DirectoryExpected(path)
 
-                with self.open_dir(path) as d:
-                    entries = d.read()
+                d = self.open_dir(path)
+            except ResultException as e:
+                if e.result == 0x202:
+                    raise fs.errors.ResourceNotFound(path)
+                else:
+                    raise e
+
+            # The directory stays open while the entries are being iterated,
+            # and is closed as soon as they run out or the iterator is closed
+            def entry_iter():
+                try:
+                    for x in d.iter_entries(page_size):
+                        if self.metadata_cache is not None:
+                            self.metadata_cache.update(path.rstrip("/") + "/" + x.name, is_file=x.is_file, size=x.size)
+
+                        yield x
+                except ResultException as e:
+                    if e.result == 0x202:
+                        raise fs.errors.ResourceNotFound(path)
+                    else:
+                        raise e
+                finally:
+                    d.close()
+
+            return entry_iter()
+
+        def listdir_array(self, path):
+            # Entries as a NumPy structured array with name, type and size fields,
+            # see Directory.entry_names for the names as strings
+            if path[0] != "/":
+                path = "/" + path
+
+            try:
+                if self.is_file(path):
+                    raise fs.errors.DirectoryExpected(path)
 
-                return [x.name for x in entries]
+                with self.open_dir(path) as d:
+                    return d.read_all_array()
             except ResultException as e:
                 if e.result == 0x202:
                     raise fs.errors.ResourceNotFound(path)
@@ -444,7 +1150,9 @@ class FspSrv(Service):
 
                 for c in mode:
                     if c == "r" in mode:
-                        if not self.is_file(path):
+                        # An idle handle to the path means it's known to be a file
+                        cached = self.handle_cache is not None and self.handle_cache.has_path(path)
+                        if not cached and not self.is_file(path):
                             raise fs.errors.FileExpected(path)
 
                         mode_tmp += "r"
@@ -469,7 +1177,7 @@ class FspSrv(Service):
                         elif "w" in mode_tmp or "a" in mode_tmp:
                             mode_tmp += "r"
 
-                return self.open_file(path, mode_tmp)
+                return self.open_cached(path, mode_tmp)
 
             except ResultException as e:
                 if e.result == 0x202:
@@ -541,6 +1249,41 @@ class FspSrv(Service):
 
         # Non-essential FS methods
 
+        def scandir(self, path, namespaces=None, page=None):
+            if path[0] != "/":
+                path = "/" + path
+
+            entries = None
+            if self.prefetched is not None:
+                entries = self.prefetched.get(fs.path.normpath(path))
+
+            source = None
+            if entries is None:
+                source = self.iter_entries(path)
+                entries = ((x.name, not x.is_file, x.size) for x in source)
+
+            if page is not None:
+                entries = itertools.islice(entries, *page)
+
+            def info_iter():
+                try:
+                    for name, is_dir, size in entries:
+                        entry_path = path.rstrip("/") + "/" + name
+
+                        try:
+                            yield self.make_info(entry_path, is_dir, size, namespaces)
+                        except ResultException as e:
+                            if e.result == 0x202:
+                                raise fs.errors.ResourceNotFound(entry_path)
+                            else:
+                                raise e
+                finally:
+                    # Pages that stop early would otherwise leave the directory open
+                    if source is not None:
+                        source.close()
+
+            return info_iter()
+
         def removetree(self, path):
             if path[0] != "/":
                 path = "/" + path
@@ -560,6 +1303,19 @@ class FspSrv(Service):
                 else:
                     raise e
 
+        def tree(self, path="/", max_levels=5, **kwargs):
+            if max_levels is None:
+                max_depth = None
+            else:
+                max_depth = max_levels + 1
+
+            self.prefetched = self.walk_listing(path, max_depth)
+
+            try:
+                fs.tree.render(self, path, max_levels=max_levels, **kwargs)
+            finally:
+                self.prefetched = None
+
         def move(self, src_path, dst_path, overwrite=False):
             if src_path[0] != "/":
                 src_path = "/" + src_path
@@ -609,6 +1365,7 @@ class FspSrv(Service):
             in_send_pid=True
         )
 
+    @memoize()
     def is_exfat_supported(self):
         if self.version < (2,0,0):
             return False
@@ -630,7 +1387,7 @@ class FspSrv(Service):
 
         out = self.dispatch(11, c_uint32(partition_id),
             buffers=(
-                (self.FileSystem.PathType(*path.encode()), SfBufferAttr.HipcPointer),
+                (self.FileSystem.path_buffer(path), SfBufferAttr.HipcPointer),
             ),
             out_num_objects=1
         )
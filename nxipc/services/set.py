@@ -1,6 +1,7 @@
 from ctypes import *
 
 from ..types import SfBufferAttr, HosVersion
+from ..cache import memoize
 from . import Service
 
 class SetSys(Service):
@@ -26,6 +27,7 @@ class SetSys(Service):
         def hos_version(self):
             return HosVersion(self.major, self.minor, self.micro)
 
+    @memoize()
     def get_version(self):
         if self.version >= (3,0,0):
             cmd_id = 4
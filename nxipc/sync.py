@@ -0,0 +1,255 @@
+import os
+import json
+import shutil
+import hashlib
+
+from . import util
+
+class Manifest:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.files = json.load(f)["files"]
+
+    def get(self, rel_path):
+        return self.files.get(rel_path)
+
+    def set(self, rel_path, size, local_mtime, remote_modified, hash=None):
+        self.files[rel_path] = {
+            "size":            size,
+            "local_mtime":     local_mtime,
+            "remote_modified": remote_modified,
+            "hash":            hash,
+        }
+
+    def remove(self, rel_path):
+        self.files.pop(rel_path, None)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f)
+
+        os.replace(tmp_path, self.path)
+
+class SyncStats(util.TransferStats):
+    def __init__(self):
+        super().__init__()
+
+        self.skipped = 0
+
+        self.files_transferred = 0
+        self.files_skipped     = 0
+        self.files_deleted     = 0
+
+    def __str__(self):
+        return (f"{self.files_transferred} files transferred ({super().__str__()}), "
+                f"{self.files_skipped} files skipped ({self.skipped:#x} bytes), "
+                f"{self.files_deleted} deleted")
+
+    def __repr__(self):
+        return f"SyncStats({str(self)})"
+
+class Sync:
+    def __init__(self, filesystem, remote_root, local_root, manifest_path=None, hash=False, chunk_size=None):
+        self.fs = filesystem
+
+        self.remote_root = "/" + remote_root.strip("/")
+        self.local_root = os.path.abspath(local_root)
+
+        # Kept next to the local directory so it doesn't get synced itself
+        if manifest_path is None:
+            manifest_path = self.local_root + ".nxipc-manifest.json"
+
+        self.manifest = Manifest(manifest_path)
+
+        self.hash = hash
+        self.chunk_size = chunk_size
+
+    def remote_path(self, rel_path):
+        return self.remote_root.rstrip("/") + "/" + rel_path
+
+    def local_path(self, rel_path):
+        return os.path.join(self.local_root, *rel_path.split("/"))
+
+    def remote_listing(self):
+        files = {}
+        dirs = set()
+
+        prefix_len = len(self.remote_root.rstrip("/")) + 1
+        for path, is_dir, size, modified in self.fs.walk_fast(self.remote_root, timestamps=True):
+            rel_path = path[prefix_len:]
+
+            if is_dir:
+                dirs.add(rel_path)
+            else:
+                files[rel_path] = (size, modified)
+
+        return files, dirs
+
+    def local_listing(self):
+        files = {}
+        dirs = set()
+
+        for root, dir_names, file_names in os.walk(self.local_root):
+            rel_root = os.path.relpath(root, self.local_root).replace(os.sep, "/")
+            if rel_root == ".":
+                rel_root = ""
+            else:
+                rel_root += "/"
+
+            for name in dir_names:
+                dirs.add(rel_root + name)
+
+            for name in file_names:
+                st = os.stat(os.path.join(root, name))
+                files[rel_root + name] = (st.st_size, st.st_mtime_ns)
+
+        return files, dirs
+
+    def file_hash(self, path):
+        h = hashlib.sha256()
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(0x100000), b""):
+                h.update(chunk)
+
+        return h.hexdigest()
+
+    def unchanged(self, rel_path, local, remote):
+        entry = self.manifest.get(rel_path)
+        if entry is None or local is None or remote is None:
+            return False
+
+        if local[0] != remote[0] or entry["size"] != local[0] or entry["remote_modified"] != remote[1]:
+            return False
+
+        if entry["local_mtime"] == local[1]:
+            return True
+
+        # Only the local modification time changed, the contents may still be the same
+        if self.hash and entry["hash"] is not None:
+            if self.file_hash(self.local_path(rel_path)) == entry["hash"]:
+                entry["local_mtime"] = local[1]
+
+                return True
+
+        return False
+
+    def record(self, rel_path, remote_modified):
+        local_path = self.local_path(rel_path)
+        st = os.stat(local_path)
+
+        if self.hash:
+            hash = self.file_hash(local_path)
+        else:
+            hash = None
+
+        self.manifest.set(rel_path, st.st_size, st.st_mtime_ns, remote_modified, hash)
+
+    def push(self, delete=False, progress=None):
+        stats = SyncStats()
+
+        if self.remote_root != "/" and not self.fs.exists(self.remote_root):
+            self.fs.makedirs(self.remote_root)
+
+        local_files, local_dirs = self.local_listing()
+        remote_files, remote_dirs = self.remote_listing()
+
+        for rel_path in sorted(local_dirs - remote_dirs):
+            self.fs.create_dir(self.remote_path(rel_path))
+
+        for rel_path, local in sorted(local_files.items()):
+            if self.unchanged(rel_path, local, remote_files.get(rel_path)):
+                stats.skipped += local[0]
+                stats.files_skipped += 1
+
+                continue
+
+            remote_path = self.remote_path(rel_path)
+
+            self.fs.upload(self.local_path(rel_path), remote_path, self.chunk_size)
+            self.record(rel_path, self.fs.get_file_timestamp(remote_path).modified)
+
+            stats.add(local[0])
+            stats.files_transferred += 1
+
+            if progress is not None:
+                progress(stats)
+
+        if delete:
+            # Whole directories go in one recursive delete each
+            removed_dirs = sorted(remote_dirs - local_dirs)
+            for rel_path in top_level(removed_dirs):
+                self.fs.delete_dir(self.remote_path(rel_path))
+
+            for rel_path in remote_files.keys() - local_files.keys():
+                if not under(rel_path, removed_dirs):
+                    self.fs.delete_file(self.remote_path(rel_path))
+
+                self.manifest.remove(rel_path)
+                stats.files_deleted += 1
+
+        self.manifest.save()
+        stats.finish()
+
+        return stats
+
+    def pull(self, delete=False, progress=None):
+        stats = SyncStats()
+
+        local_files, local_dirs = self.local_listing()
+        remote_files, remote_dirs = self.remote_listing()
+
+        os.makedirs(self.local_root, exist_ok=True)
+
+        for rel_path in sorted(remote_dirs - local_dirs):
+            os.makedirs(self.local_path(rel_path), exist_ok=True)
+
+        for rel_path, remote in sorted(remote_files.items()):
+            if self.unchanged(rel_path, local_files.get(rel_path), remote):
+                stats.skipped += remote[0]
+                stats.files_skipped += 1
+
+                continue
+
+            # Download next to the destination so an interrupted pull never leaves a partial file
+            local_path = self.local_path(rel_path)
+            tmp_path = local_path + ".nxipc-part"
+
+            self.fs.download(self.remote_path(rel_path), tmp_path, self.chunk_size)
+            os.replace(tmp_path, local_path)
+
+            self.record(rel_path, remote[1])
+
+            stats.add(remote[0])
+            stats.files_transferred += 1
+
+            if progress is not None:
+                progress(stats)
+
+        if delete:
+            removed_dirs = sorted(local_dirs - remote_dirs)
+            for rel_path in top_level(removed_dirs):
+                shutil.rmtree(self.local_path(rel_path))
+
+            for rel_path in local_files.keys() - remote_files.keys():
+                if not under(rel_path, removed_dirs):
+                    os.remove(self.local_path(rel_path))
+
+                self.manifest.remove(rel_path)
+                stats.files_deleted += 1
+
+        self.manifest.save()
+        stats.finish()
+
+        return stats
+
+def under(rel_path, dirs):
+    return any(rel_path.startswith(x + "/") for x in dirs)
+
+def top_level(dirs):
+    return [x for x in dirs if not under(x, dirs)]
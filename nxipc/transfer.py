@@ -0,0 +1,281 @@
+import os
+import abc
+import json
+import zlib
+
+from . import util
+from .types import ResultException, Priority
+from .commands import Read
+
+class Checkpoint:
+    # A header line, then a line per chunk with its CRC32 in fixed-width hex,
+    # so recording a chunk is an append and forgetting one is a truncate
+    entry_size = 9
+
+    def __init__(self, path, size, chunk_size):
+        self.path = path
+        self.size = size
+        self.chunk_size = chunk_size
+
+        self.header = (json.dumps({"size": size, "chunk_size": chunk_size}) + "\n").encode()
+
+        self.checksums = []
+        self.file = None
+
+        # A checkpoint for a different transfer can't be resumed from
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+
+            if data.startswith(self.header):
+                body = data[len(self.header):]
+
+                # Whatever was cut off in the middle of a line is dropped
+                try:
+                    self.checksums = [
+                        int(body[start:start + self.entry_size - 1], 16)
+                        for start in range(0, len(body) - self.entry_size + 1, self.entry_size)
+                    ]
+                except ValueError:
+                    self.checksums = []
+
+    @property
+    def offset(self):
+        return min(len(self.checksums) * self.chunk_size, self.size)
+
+    def entry(self, checksum):
+        return f"{checksum:08x}\n".encode()
+
+    def open(self):
+        # Written out whole once, and from then on only appended to or truncated
+        if self.file is not None:
+            return
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.header + b"".join(self.entry(x) for x in self.checksums))
+
+        os.replace(tmp_path, self.path)
+
+        self.file = open(self.path, "r+b")
+        self.file.seek(0, os.SEEK_END)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def add(self, checksum):
+        self.open()
+
+        self.checksums.append(checksum)
+        self.file.write(self.entry(checksum))
+        self.sync()
+
+    def pop(self):
+        self.open()
+
+        self.checksums.pop()
+        self.file.truncate(len(self.header) + len(self.checksums) * self.entry_size)
+        self.file.seek(0, os.SEEK_END)
+        self.sync()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ResumableTransfer(abc.ABC):
+    chunk_size = 0x100000
+    retries    = 5
+
+    def __init__(self, h, size, sidecar, chunk_size=None, retries=None):
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+
+        if retries is not None:
+            self.retries = retries
+
+        self.h = h
+        self.size = size
+
+        self.checkpoint = Checkpoint(sidecar, size, chunk_size)
+
+    @abc.abstractmethod
+    def read_chunk(self, offset, size):
+        pass
+
+    @abc.abstractmethod
+    def write_chunk(self, offset, data):
+        pass
+
+    # Returns what's at the destination, to check chunks written before an interruption
+    @abc.abstractmethod
+    def read_back(self, offset, size):
+        pass
+
+    def finish(self):
+        pass
+
+    def chunk_range(self, index):
+        offset = index * self.checkpoint.chunk_size
+
+        return offset, min(self.checkpoint.chunk_size, self.size - offset)
+
+    def verify(self):
+        # Only the last chunk can have been cut off, but go back further if it was never written at all
+        while len(self.checkpoint.checksums) > 0:
+            offset, size = self.chunk_range(len(self.checkpoint.checksums) - 1)
+
+            data = self.read_back(offset, size)
+            if data is not None and len(data) == size and zlib.crc32(data) == self.checkpoint.checksums[-1]:
+                break
+
+            self.checkpoint.pop()
+
+    def run(self, progress=None):
+        import usb.core
+
+        stats = util.TransferStats(self.size)
+
+        failures = 0
+        try:
+            while True:
+                try:
+                    self.verify()
+
+                    while self.checkpoint.offset < self.size:
+                        offset, size = self.chunk_range(len(self.checkpoint.checksums))
+
+                        data = self.read_chunk(offset, size)
+                        if len(data) != size:
+                            raise IOError(f"Short read at {offset:#x}: {len(data):#x} of {size:#x} bytes")
+
+                        self.write_chunk(offset, data)
+                        self.checkpoint.add(zlib.crc32(data))
+
+                        stats.add(size)
+                        if progress is not None:
+                            progress(stats)
+
+                    break
+                except usb.core.USBError:
+                    failures += 1
+                    if failures > self.retries:
+                        raise
+
+                    self.h.reconnect()
+        finally:
+            self.checkpoint.close()
+
+        self.finish()
+        self.checkpoint.remove()
+
+        stats.finish()
+
+        return stats
+
+class LocalDestination(ResumableTransfer):
+    def __init__(self, h, size, dst, sidecar=None, *args, **kwargs):
+        if sidecar is None:
+            sidecar = dst + ".nxipc-resume"
+
+        super().__init__(h, size, sidecar, *args, **kwargs)
+
+        if len(self.checkpoint.checksums) > 0 and os.path.exists(dst):
+            self.dst = open(dst, "r+b")
+        else:
+            self.dst = open(dst, "w+b")
+
+    def write_chunk(self, offset, data):
+        self.dst.seek(offset)
+        self.dst.write(data)
+
+        # What's in the checkpoint has to actually be on disk
+        self.dst.flush()
+        os.fsync(self.dst.fileno())
+
+    def read_back(self, offset, size):
+        self.dst.seek(offset)
+
+        return self.dst.read(size)
+
+    def finish(self):
+        self.dst.truncate(self.size)
+        self.dst.close()
+
+class FilePull(LocalDestination):
+    def __init__(self, file, dst, *args, **kwargs):
+        self.file = file
+
+        super().__init__(file.srv.h, file.size(), dst, *args, **kwargs)
+
+    def read_chunk(self, offset, size):
+        return self.file.read_raw(size, offset)
+
+class MemoryDump(LocalDestination):
+    def __init__(self, h, ptr, size, dst, *args, **kwargs):
+        if not isinstance(ptr, int):
+            ptr = ptr.value
+
+        self.ptr = ptr
+
+        super().__init__(h, size, dst, *args, **kwargs)
+
+    def read_chunk(self, offset, size):
+        return self.h.execute(Read, self.ptr + offset, size, priority=Priority.Bulk)
+
+class FilePush(ResumableTransfer):
+    def __init__(self, src, file, sidecar=None, *args, **kwargs):
+        if sidecar is None:
+            sidecar = src + ".nxipc-resume"
+
+        self.src = open(src, "rb")
+        self.file = file
+
+        super().__init__(file.srv.h, os.fstat(self.src.fileno()).st_size, sidecar, *args, **kwargs)
+
+    def read_chunk(self, offset, size):
+        self.src.seek(offset)
+
+        return self.src.read(size)
+
+    def write_chunk(self, offset, data):
+        self.file.write_raw(data, offset)
+
+    def read_back(self, offset, size):
+        return self.file.read_raw(size, offset)
+
+    def finish(self):
+        self.file.flush()
+        self.src.close()
+
+def pull(filesystem, path, dst, chunk_size=None, retries=None, progress=None, sidecar=None):
+    with filesystem.open_file(path) as f:
+        return FilePull(f, dst, sidecar, chunk_size, retries).run(progress)
+
+def push(filesystem, src, path, chunk_size=None, retries=None, progress=None, sidecar=None):
+    size = os.path.getsize(src)
+
+    if sidecar is None:
+        sidecar = src + ".nxipc-resume"
+
+    # Resuming needs what was already sent, otherwise start over with a file of the final size
+    if not os.path.exists(sidecar) or not filesystem.exists(path):
+        try:
+            filesystem.delete_file(path)
+        except ResultException:
+            pass
+
+        filesystem.create_file(path, size, big=size >= 0x100000000)
+
+    with filesystem.open_file(path, "rw") as f:
+        return FilePush(src, f, sidecar, chunk_size, retries).run(progress)
+
+def dump(h, ptr, size, dst, chunk_size=None, retries=None, progress=None, sidecar=None):
+    return MemoryDump(h, ptr, size, dst, sidecar, chunk_size, retries).run(progress)
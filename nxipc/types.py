@@ -52,6 +52,11 @@ class ServiceStruct(LittleEndianStructure):
     def is_domain_subservice(self):
         return self.active and self.own_handle == 0 and self.object_id != 0
 
+class Priority(enum.IntEnum):
+    High   = 0
+    Normal = 1
+    Bulk   = 2
+
 class SfBufferAttr(enum.Enum):
     In                             = 1 << 0
     Out                            = 1 << 1
@@ -68,12 +73,32 @@ class SfBufferAttr(enum.Enum):
 
         return self.value | other
 
+    # A chain of more than two attributes ORs the rest into a plain int
+    __ror__ = __or__
+
 class SfBuffer(LittleEndianStructure):
     _fields_ = [
         ("ptr",  c_void_p),
         ("size", c_uint64),
     ]
 
+class CompactBuffer:
+    # A fixed-size In buffer that's mostly trailing zeroes, which only has its start sent
+    def __init__(self, data, size):
+        data = bytes(data).rstrip(b"\0")
+        if len(data) > size:
+            raise ValueError(f"Data too long: {len(data):#x} bytes for a {size:#x} byte buffer")
+
+        self.data = data
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    # The whole buffer, for consoles that can't take the compact form
+    def __bytes__(self):
+        return self.data + bytes(self.size - len(self.data))
+
 class SfOutHandleAttr(enum.Enum):
     Blank    = 0
     HipcCopy = 1
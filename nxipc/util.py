@@ -1,3 +1,9 @@
+import time
+import heapq
+import threading
+import itertools
+import contextlib
+
 def align(value, a, up=True):
     if up:
         return (value + a - 1) & ~(a - 1)
@@ -10,4 +16,97 @@ def bit(*args):
     for arg in args:
         ret |= 1 << arg
 
-    return ret
\ No newline at end of file
+    return ret
+
+def byte_view(*args):
+    views = [memoryview(x) for x in args if x is not None]
+    if len(views) == 0:
+        return memoryview(b"")
+
+    # Only a single contiguous object can be sent without joining into a copy
+    if len(views) > 1 or not views[0].c_contiguous:
+        return memoryview(b"".join(x.tobytes() for x in views))
+
+    return views[0].cast("B")
+
+class TransferStats:
+    def __init__(self, total=None):
+        self.total = total
+        self.transferred = 0
+
+        self.start = time.perf_counter()
+        self.end = None
+
+    def add(self, size):
+        self.transferred += size
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        if self.end is None:
+            return time.perf_counter() - self.start
+
+        return self.end - self.start
+
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        if elapsed == 0:
+            return 0
+
+        return self.transferred / elapsed
+
+    def __str__(self):
+        return f"{self.transferred:#x} bytes in {self.elapsed:.2f}s ({self.throughput / 0x100000:.2f} MiB/s)"
+
+    def __repr__(self):
+        return f"TransferStats({str(self)})"
+
+class PriorityLock:
+    # Waiters are let in lowest priority value first, and in arrival order within a priority
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.counter = itertools.count()
+
+        self.owner = None
+        self.depth = 0
+
+    def acquire(self, priority):
+        ident = threading.get_ident()
+
+        with self.cond:
+            if self.owner == ident:
+                self.depth += 1
+
+                return
+
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+
+            while self.owner is not None or self.waiting[0] != ticket:
+                self.cond.wait()
+
+            heapq.heappop(self.waiting)
+
+            self.owner = ident
+            self.depth = 1
+
+    def release(self):
+        with self.cond:
+            self.depth -= 1
+
+            if self.depth == 0:
+                self.owner = None
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def __call__(self, priority):
+        self.acquire(priority)
+
+        try:
+            yield
+        finally:
+            self.release()
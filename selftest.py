@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# Runs the host side against the emulator, so paths that need a console still get exercised
+
+import io
+import os
+import sys
+import tempfile
+
+import fs.errors
+
+import nxipc
+from nxipc.emulator import Emulator, EmulatedFspSrv, EmulatedSetSys
+
+checks = []
+
+def check(func):
+    checks.append(func)
+
+    return func
+
+@check
+def readinto_uncached(emu, root, sd):
+    data = os.urandom(0x12345)
+    with open(os.path.join(root, "readinto.bin"), "wb") as f:
+        f.write(data)
+
+    with sd.open_file("/readinto.bin") as f:
+        buf = bytearray(len(data) + 0x10)
+        assert f.readinto(buf) == len(data)
+        assert buf[:len(data)] == data
+
+        # Partial reads into a view go to the right place
+        buf = bytearray(0x100)
+        assert f.readinto(memoryview(buf)[0x10:0x20], 0x1000) == 0x10
+        assert buf[0x10:0x20] == data[0x1000:0x1010]
+        assert f.tell() == 0x1010
+
+    dst = io.BytesIO()
+    sd.download("/readinto.bin", dst)
+    assert dst.getvalue() == data
+
+@check
+def block_cache_paths(emu, root, sd):
+    with open(os.path.join(root, "cached.bin"), "wb") as f:
+        f.write(os.urandom(0x100))
+
+    sd.block_cache = nxipc.cache.BlockCache()
+    try:
+        data = sd.readbytes("/cached.bin")
+
+        # Different spellings of the same path share blocks
+        emu.reset_counters()
+        with sd.open_file("cached.bin") as f:
+            assert f.read() == data
+        with sd.open_file("/sub/../cached.bin") as f:
+            assert f.read() == data
+
+        assert emu.requests_handled[("EmulatedFile", 0)] == 0
+
+        sd.remove("/cached.bin")
+        assert len(sd.block_cache.paths) == 0
+    finally:
+        sd.block_cache = None
+
+@check
+def packed_files(emu, root, sd):
+    # Advertised the same as by the console
+    assert sd.srv.h.capabilities & nxipc.commands.GetDeviceInfo.PackFiles
+
+    src = io.BytesIO(b"skipped contents")
+    src.seek(8)
+
+    results = sd.upload_many([("/packed/a.txt", src), ("/packed/b.txt", b"bytes")])
+    assert [result == 0 for _, result in results] == [True, True]
+
+    files = sd.download_many(["/packed/a.txt", "packed/b.txt"])
+    assert [bytes(data) for _, _, data in files] == [b"contents", b"bytes"]
+
+    try:
+        sd.download_many(["/" + "x" * 0x40000])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Path longer than a batch was accepted")
+
+@check
+def pooled_handles(emu, root, sd):
+    for name in ("pooled1.bin", "pooled2.bin"):
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(name.encode())
+
+    sd.handle_cache = nxipc.cache.HandleCache()
+    try:
+        f = sd.openbin("/pooled1.bin")
+        f.close()
+
+        # The session went back to the pool, but the File that was using it is done with it
+        assert f.closed
+        try:
+            f.read()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Read through a released handle")
+
+        f = sd.openbin("/pooled1.bin")
+        g = sd.openbin("/pooled2.bin")
+
+        # Only invalidations of their own paths keep handles out of the pool
+        sd.remove("/pooled2.bin")
+        f.close()
+        g.close()
+
+        assert sd.handle_cache.has_path("/pooled1.bin")
+        assert not sd.handle_cache.has_path("/pooled2.bin")
+
+        # Invalidating another spelling of the path closes the idle handle too
+        sd.remove("sub/../pooled1.bin")
+        assert not sd.handle_cache.has_path("/pooled1.bin")
+    finally:
+        sd.handle_cache.clear()
+        sd.handle_cache = None
+
+@check
+def handler_commands(emu, root, sd):
+    h = sd.srv.h
+
+    pong = h.execute(nxipc.commands.Ping, 0x1234)
+    assert pong.nonce == 0x1234
+
+    data = os.urandom(0x1000)
+    ptr = h.execute(nxipc.commands.Allocate, "malloc", len(data))
+    h.execute(nxipc.commands.Write, ptr, data)
+    assert h.execute(nxipc.commands.Read, ptr, len(data)) == data
+    h.execute(nxipc.commands.Free, ptr)
+
+    # Channels are handlers of their own, over the same link
+    with nxipc.mux.Multiplexer(h, 2) as mux:
+        for i, channel in enumerate(mux):
+            assert channel.execute(nxipc.commands.Ping, i).nonce == i
+
+    assert h.execute(nxipc.commands.Ping, 1).nonce == 1
+
+@check
+def file_seek(emu, root, sd):
+    with open(os.path.join(root, "seek.bin"), "wb") as f:
+        f.write(bytes(range(0x10)))
+
+    with sd.open_file("/seek.bin") as f:
+        assert f.seek(-4, os.SEEK_END) == 0xc
+        assert f.read(2) == bytes([0xc, 0xd])
+        assert f.seek(-2, os.SEEK_CUR) == 0xc
+
+        for args in ((-1,), (-0x11, os.SEEK_END), (0, 3)):
+            try:
+                f.seek(*args)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError(f"seek{args} was accepted")
+
+        assert f.tell() == 0xc
+
+@check
+def metadata_cache_paths(emu, root, sd):
+    with open(os.path.join(root, "meta.bin"), "wb") as f:
+        f.write(bytes(4))
+
+    sd.metadata_cache = nxipc.cache.MetadataCache(ttl=None)
+    try:
+        assert sd.getsize("/meta.bin") == 4
+
+        # Writing through another spelling of the path still drops what was cached
+        sd.writebytes("sub/../meta.bin", bytes(8))
+        assert sd.getsize("/meta.bin") == 8
+
+        sd.makedir("/metadir")
+        sd.writebytes("/metadir/x.bin", bytes(2))
+        assert sd.isfile("/metadir/x.bin")
+
+        sd.removetree("metadir/")
+        assert not sd.exists("/metadir/x.bin")
+    finally:
+        sd.metadata_cache = None
+
+@check
+def walk_subfs(emu, root, sd):
+    os.makedirs(os.path.join(root, "walk", "sub"))
+    for name in ("walk/a.bin", "walk/sub/b.bin"):
+        with open(os.path.join(root, name), "wb") as f:
+            f.write(bytes(1))
+
+    # Sub-filesystems have no walk_listing of their own
+    walk = sd.opendir("/walk")
+    assert sorted(walk.walk.files()) == ["/a.bin", "/sub/b.bin"]
+    assert list(walk.walk.dirs()) == ["/sub"]
+
+    for path, error in (("/walk/a.bin", fs.errors.DirectoryExpected), ("/nothing", fs.errors.ResourceNotFound)):
+        try:
+            sd.walk_fast(path)
+        except error:
+            pass
+        else:
+            raise AssertionError(f"walk_fast({path!r}) didn't raise {error.__name__}")
+
+def main():
+    failed = False
+
+    with tempfile.TemporaryDirectory() as root:
+        emu = Emulator({
+            b"fsp-srv": lambda e: EmulatedFspSrv(e, root),
+            b"set:sys": EmulatedSetSys,
+        }).start()
+
+        h = emu.handler()
+        h.load_firmware_version()
+
+        fsp = nxipc.services.FspSrv(h)
+        sd = fsp.open_sd_card_fs()
+
+        for func in checks:
+            try:
+                func(emu, root, sd)
+            except Exception as e:
+                print(f"{func.__name__}: FAILED ({type(e).__name__}: {e})")
+                failed = True
+            else:
+                print(f"{func.__name__}: ok")
+
+        sd.close()
+        fsp.close()
+
+        h.execute(nxipc.commands.Exit)
+        emu.stop()
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
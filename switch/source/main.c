@@ -7,6 +7,31 @@
 
 #define MAX_READ_WRITE 0xe00
 
+#define WALK_TREE_CHUNK_SIZE 0x4000
+#define WALK_TREE_PAGE_SIZE  0x40
+
+#define WALK_TREE_FLAG_TIMESTAMPS BIT(0)
+
+#define PACK_BUFFER_SIZE 0x100000
+#define PACK_PATHS_SIZE  0x40000
+
+#define PING_MAGIC 0x474e50435049584e // "NXIPCPNG"
+
+#define MUX_CONTROL_CHANNEL 0xffffffff
+#define MUX_MAX_CHANNELS    8
+#define MUX_FRAME_SIZE      0x10000
+#define MUX_STACK_SIZE      0x20000
+#define MUX_THREAD_PRIORITY 0x2c
+
+#define PROTOCOL_VERSION 1
+
+#define CAPABILITY_PING           BIT(0)
+#define CAPABILITY_CHANNELS       BIT(1)
+#define CAPABILITY_COMPACT_BUFFER BIT(2)
+#define CAPABILITY_PACK_FILES     BIT(3)
+
+#define CAPABILITIES (CAPABILITY_PING | CAPABILITY_CHANNELS | CAPABILITY_COMPACT_BUFFER | CAPABILITY_PACK_FILES)
+
 //#define DEBUG
 
 #ifdef DEBUG
@@ -44,8 +69,25 @@ typedef enum {
     CommandId_ConvertServiceToDomain = 7,
 
     CommandId_DispatchToService      = 8,
+
+    CommandId_WalkTree               = 9,
+    CommandId_UnpackFiles            = 10,
+    CommandId_PackFiles              = 11,
+
+    CommandId_Nop                    = 12,
+    CommandId_Ping                   = 13,
+
+    CommandId_EnableChannels         = 14,
+
+    CommandId_GetDeviceInfo          = 15,
 } CommandId;
 
+typedef enum {
+    BufferKind_Inline  = 0,
+    BufferKind_Pointer = 1,
+    BufferKind_Compact = 2, // Only the start of the buffer is sent, the rest is zeroes
+} BufferKind;
+
 typedef enum {
     AllocateType_Malloc   = 0,
     AllocateType_Calloc   = 1,
@@ -56,7 +98,7 @@ Result smIsServiceRegistered(SmServiceName name, bool *out) {
     return serviceDispatchInOut(smGetServiceSession(), 65100, name, *out);
 }
 
-void usb_read(void *buf, size_t size) {
+void raw_usb_read(void *buf, size_t size) {
     for (size_t tmp_size = 0; tmp_size < size; tmp_size += MAX_READ_WRITE) {
         size_t to_read;
         if (size - tmp_size > MAX_READ_WRITE) {
@@ -69,7 +111,7 @@ void usb_read(void *buf, size_t size) {
     }
 }
 
-void usb_write(const void *buf, size_t size) {
+void raw_usb_write(const void *buf, size_t size) {
     for (size_t tmp_size = 0; tmp_size < size; tmp_size += MAX_READ_WRITE) {
         size_t to_write;
         if (size - tmp_size > MAX_READ_WRITE) {
@@ -82,6 +124,120 @@ void usb_write(const void *buf, size_t size) {
     }
 }
 
+typedef struct MuxFrame {
+    struct MuxFrame *next;
+
+    u32 size;
+    u32 pos;
+
+    u8 data[];
+} MuxFrame;
+
+typedef struct {
+    u32 id;
+
+    Thread thread;
+
+    Mutex mutex;
+    CondVar cond;
+
+    MuxFrame *head;
+    MuxFrame *tail;
+
+    bool closed;
+} MuxChannel;
+
+typedef struct {
+    u32 channel;
+    u32 size;
+} MuxHeader;
+
+static MuxChannel mux_channels[MUX_MAX_CHANNELS];
+static Mutex mux_write_mutex;
+
+// Set on worker threads so commands are served over their channel instead of the raw link
+static __thread MuxChannel *current_channel = NULL;
+
+void mux_channel_read(MuxChannel *ch, void *buf, size_t size) {
+    mutexLock(&ch->mutex);
+
+    while (size > 0) {
+        while (ch->head == NULL && !ch->closed) {
+            condvarWait(&ch->cond, &ch->mutex);
+        }
+
+        // Nothing more is coming, the worker will stop after this command
+        if (ch->head == NULL) {
+            memset(buf, 0, size);
+
+            break;
+        }
+
+        MuxFrame *frame = ch->head;
+
+        size_t to_copy = frame->size - frame->pos;
+        if (to_copy > size) {
+            to_copy = size;
+        }
+
+        memcpy(buf, frame->data + frame->pos, to_copy);
+        frame->pos += to_copy;
+
+        buf += to_copy;
+        size -= to_copy;
+
+        if (frame->pos == frame->size) {
+            ch->head = frame->next;
+            if (ch->head == NULL) {
+                ch->tail = NULL;
+            }
+
+            free(frame);
+        }
+    }
+
+    mutexUnlock(&ch->mutex);
+}
+
+void mux_channel_write(MuxChannel *ch, const void *buf, size_t size) {
+    for (size_t tmp_size = 0; tmp_size < size; tmp_size += MUX_FRAME_SIZE) {
+        MuxHeader header = {
+            .channel = ch->id,
+        };
+
+        if (size - tmp_size > MUX_FRAME_SIZE) {
+            header.size = MUX_FRAME_SIZE;
+        } else {
+            header.size = size - tmp_size;
+        }
+
+        mutexLock(&mux_write_mutex);
+
+        if (!ch->closed) {
+            raw_usb_write(&header, sizeof(header));
+            raw_usb_write(buf + tmp_size, header.size);
+        }
+
+        mutexUnlock(&mux_write_mutex);
+    }
+}
+
+void usb_read(void *buf, size_t size) {
+    if (current_channel != NULL) {
+        mux_channel_read(current_channel, buf, size);
+    } else {
+        raw_usb_read(buf, size);
+    }
+}
+
+void usb_write(const void *buf, size_t size) {
+    if (current_channel != NULL) {
+        mux_channel_write(current_channel, buf, size);
+    } else {
+        raw_usb_write(buf, size);
+    }
+}
+
 inline void write_result(Result rc) {
     usb_write(&rc, sizeof(rc));
 }
@@ -272,19 +428,26 @@ void DispatchToService() {
         struct {
             u64 size;
             u32 attr;
-            bool is_pointer;
+            u8 kind;
         } buffer;
         usb_read(&buffer, sizeof(buffer));
 
         params.buffers[i].size = buffer.size;
         
-        if (buffer.is_pointer) {
+        if (buffer.kind == BufferKind_Pointer) {
             usb_read(&params.buffers[i].ptr, sizeof(void *));
             buffer_is_pointer[i] = true;
         } else {
             params.buffers[i].ptr  = malloc(buffer.size);
 
-            if (buffer.attr & SfBufferAttr_In) {
+            if (buffer.kind == BufferKind_Compact) {
+                u32 len;
+                usb_read(&len, sizeof(len));
+
+                // The host never sends more than the buffer's size
+                usb_read((void *) params.buffers[i].ptr, len);
+                memset((void *) params.buffers[i].ptr + len, 0, buffer.size - len);
+            } else if (buffer.attr & SfBufferAttr_In) {
                 usb_read((void *) params.buffers[i].ptr, buffer.size);
             }
         }
@@ -322,70 +485,731 @@ void DispatchToService() {
     }
 }
 
-int main(int argc, char **argv) {
-    #ifdef DEBUG
+typedef struct {
+    u16 path_len;
+    u8 type;
+    s64 size;
+} __attribute__((packed)) WalkTreeRecord;
 
-    consoleInit(NULL);
+typedef struct {
+    FsFileSystem *fs;
+    u32 flags;
 
-    #endif
+    u32 size;
+    u8 data[WALK_TREE_CHUNK_SIZE];
+} WalkTreeOutput;
 
-    usbCommsInitialize();
+void walk_tree_flush(WalkTreeOutput *out) {
+    if (out->size == 0) {
+        return;
+    }
 
-    while (appletMainLoop()) {
-        PRINTF("loop\n");
-        u8 cmd_id;
-        usb_read(&cmd_id, sizeof(cmd_id));
-        PRINTF("%d\n", cmd_id);
+    usb_write(&out->size, sizeof(out->size));
+    usb_write(out->data, out->size);
 
-        bool should_break = false;
+    out->size = 0;
+}
 
-        switch(cmd_id) {
-            case CommandId_Exit:
-                write_result(0);
+void walk_tree_emit(WalkTreeOutput *out, const char *full_path, const char *path, u8 type, s64 size) {
+    WalkTreeRecord record = {
+        .path_len = strlen(path),
+        .type     = type,
+        .size     = size,
+    };
 
-                should_break = true;
+    if (out->size + sizeof(record) + sizeof(u64) + record.path_len > sizeof(out->data)) {
+        walk_tree_flush(out);
+    }
 
-                break;
+    memcpy(out->data + out->size, &record, sizeof(record));
+    out->size += sizeof(record);
 
-            case CommandId_Allocate:
-                Allocate();
-                break;
+    if (out->flags & WALK_TREE_FLAG_TIMESTAMPS) {
+        FsTimeStampRaw ts = {0};
+        if (type == FsDirEntryType_File) {
+            fsFsGetFileTimeStampRaw(out->fs, full_path, &ts);
+        }
 
-            case CommandId_Free:
-                Free();
-                break;
+        memcpy(out->data + out->size, &ts.modified, sizeof(ts.modified));
+        out->size += sizeof(ts.modified);
+    }
 
-            case CommandId_Read:
-                Read();
-                break;
+    memcpy(out->data + out->size, path, record.path_len);
+    out->size += record.path_len;
+}
 
-            case CommandId_Write:
-                Write();
-                break;
+// Only keeps one directory open at a time, subdirectories are walked after it's closed
+Result walk_tree(char *path, size_t prefix_len, u32 depth_left, WalkTreeOutput *out) {
+    FsDir dir;
+    Result rc = fsFsOpenDirectory(out->fs, path, FsDirOpenMode_ReadDirs | FsDirOpenMode_ReadFiles, &dir);
+    if (R_FAILED(rc)) {
+        return rc;
+    }
 
-            case CommandId_GetService:
-                GetService();
-                break;
+    size_t path_len = strlen(path);
+    size_t sep_len  = (path_len > 1) ? 1 : 0;
 
-            case CommandId_CloseService:
-                CloseService();
-                break;
+    char *subdirs = NULL;
+    size_t subdirs_size = 0;
 
-            case CommandId_ConvertServiceToDomain:
-                ConverServiceToDomain();
-                break;
+    FsDirectoryEntry *entries = malloc(WALK_TREE_PAGE_SIZE * sizeof(FsDirectoryEntry));
+    if (entries == NULL) {
+        fsDirClose(&dir);
+
+        return MAKERESULT(NXIPC_MODULE, 4);
+    }
+
+    while (true) {
+        s64 count = 0;
+        rc = fsDirRead(&dir, &count, WALK_TREE_PAGE_SIZE, entries);
+        if (R_FAILED(rc)) {
+            break;
+        }
+
+        for (s64 i = 0; i < count; i++) {
+            size_t name_len = strlen(entries[i].name);
+            if (path_len + sep_len + name_len >= FS_MAX_PATH) {
+                continue;
+            }
+
+            if (sep_len > 0) {
+                path[path_len] = '/';
+            }
+
+            memcpy(path + path_len + sep_len, entries[i].name, name_len + 1);
 
-            case CommandId_DispatchToService:
-                DispatchToService();
+            walk_tree_emit(out, path, path + prefix_len, entries[i].type, entries[i].file_size);
+
+            path[path_len] = '\0';
+
+            if (entries[i].type == FsDirEntryType_Dir && depth_left != 1) {
+                char *new_subdirs = realloc(subdirs, subdirs_size + name_len + 1);
+                if (new_subdirs == NULL) {
+                    rc = MAKERESULT(NXIPC_MODULE, 4);
+                    break;
+                }
+
+                subdirs = new_subdirs;
+
+                memcpy(subdirs + subdirs_size, entries[i].name, name_len + 1);
+                subdirs_size += name_len + 1;
+            }
+        }
+
+        if (R_FAILED(rc) || count < WALK_TREE_PAGE_SIZE) {
+            break;
+        }
+    }
+
+    free(entries);
+    fsDirClose(&dir);
+
+    for (size_t offset = 0; R_SUCCEEDED(rc) && offset < subdirs_size; offset += strlen(subdirs + offset) + 1) {
+        if (sep_len > 0) {
+            path[path_len] = '/';
+        }
+
+        strcpy(path + path_len + sep_len, subdirs + offset);
+
+        rc = walk_tree(path, prefix_len, (depth_left > 0) ? depth_left - 1 : 0, out);
+
+        path[path_len] = '\0';
+    }
+
+    free(subdirs);
+
+    return rc;
+}
+
+void WalkTree() {
+    PRINTF("WalkTree\n");
+
+    FsFileSystem fs;
+    usb_read(&fs.s, sizeof(fs.s));
+
+    struct {
+        u32 max_depth;
+        u32 flags;
+    } options;
+    usb_read(&options, sizeof(options));
+
+    char path[FS_MAX_PATH];
+    usb_read(path, sizeof(path));
+    path[FS_MAX_PATH - 1] = '\0';
+
+    WalkTreeOutput *out = malloc(sizeof(WalkTreeOutput));
+    if (out == NULL) {
+        u32 end = 0;
+        usb_write(&end, sizeof(end));
+
+        write_result(MAKERESULT(NXIPC_MODULE, 4));
+
+        return;
+    }
+
+    out->fs    = &fs;
+    out->flags = options.flags;
+    out->size  = 0;
+
+    // Records hold paths relative to the root that was walked
+    size_t prefix_len = strlen(path);
+    if (prefix_len > 1) {
+        prefix_len++;
+    }
+
+    Result rc = walk_tree(path, prefix_len, options.max_depth, out);
+
+    walk_tree_flush(out);
+    free(out);
+
+    u32 end = 0;
+    usb_write(&end, sizeof(end));
+
+    write_result(rc);
+}
+
+// Static so that running out of memory can't make us lose track of the stream
+static u8 pack_buffer[PACK_BUFFER_SIZE];
+static char pack_paths[PACK_PATHS_SIZE + 1];
+
+// The pack buffers are shared between channels
+static Mutex pack_mutex;
+
+void drain(u64 size) {
+    while (size > 0) {
+        u64 to_read = (size > PACK_BUFFER_SIZE) ? PACK_BUFFER_SIZE : size;
+        usb_read(pack_buffer, to_read);
+
+        size -= to_read;
+    }
+}
+
+void create_parent_dirs(FsFileSystem *fs, char *path, char *last_dir) {
+    char *slash = strrchr(path, '/');
+    if (slash == NULL || slash == path) {
+        return;
+    }
+
+    *slash = '\0';
+
+    // Files are usually packed directory by directory
+    if (strcmp(path, last_dir) != 0) {
+        for (char *p = path + 1; ; p++) {
+            if (*p != '/' && *p != '\0') {
+                continue;
+            }
+
+            char c = *p;
+            *p = '\0';
+
+            fsFsCreateDirectory(fs, path);
+
+            *p = c;
+
+            if (c == '\0') {
                 break;
+            }
+        }
+
+        strcpy(last_dir, path);
+    }
+
+    *slash = '/';
+}
+
+Result unpack_file(FsFileSystem *fs, char *path, u64 size, char *last_dir) {
+    create_parent_dirs(fs, path, last_dir);
+
+    fsFsDeleteFile(fs, path);
+
+    FsFile file;
+    Result rc = fsFsCreateFile(fs, path, size, (size >= 0x100000000) ? FsCreateOption_BigFile : 0);
+    if (R_SUCCEEDED(rc)) {
+        rc = fsFsOpenFile(fs, path, FsOpenMode_Write, &file);
+    }
+
+    if (R_FAILED(rc)) {
+        drain(size);
+
+        return rc;
+    }
+
+    // The payload always has to be consumed to stay in sync, even once writing fails
+    for (u64 offset = 0; offset < size; ) {
+        u64 to_read = (size - offset > PACK_BUFFER_SIZE) ? PACK_BUFFER_SIZE : size - offset;
+        usb_read(pack_buffer, to_read);
+
+        if (R_SUCCEEDED(rc)) {
+            rc = fsFileWrite(&file, offset, pack_buffer, to_read, FsWriteOption_None);
+        }
+
+        offset += to_read;
+    }
+
+    if (R_SUCCEEDED(rc)) {
+        rc = fsFileFlush(&file);
+    }
+
+    fsFileClose(&file);
+
+    return rc;
+}
+
+void UnpackFiles() {
+    PRINTF("UnpackFiles\n");
+
+    FsFileSystem fs;
+    usb_read(&fs.s, sizeof(fs.s));
+
+    u32 count;
+    usb_read(&count, sizeof(count));
+
+    Result *results = malloc(count * sizeof(Result));
+
+    char path[FS_MAX_PATH];
+    char last_dir[FS_MAX_PATH] = "";
+
+    for (u32 i = 0; i < count; i++) {
+        struct {
+            u32 path_len;
+            u64 size;
+        } header;
+        usb_read(&header, sizeof(header));
+
+        Result rc;
+        if (header.path_len >= FS_MAX_PATH) {
+            usb_read(pack_buffer, header.path_len);
+            drain(header.size);
+
+            rc = MAKERESULT(NXIPC_MODULE, 5);
+        } else {
+            usb_read(path, header.path_len);
+            path[header.path_len] = '\0';
+
+            rc = unpack_file(&fs, path, header.size, last_dir);
+        }
+
+        if (results != NULL) {
+            results[i] = rc;
+        }
+    }
+
+    if (results == NULL) {
+        write_result(MAKERESULT(NXIPC_MODULE, 4));
+
+        return;
+    }
+
+    write_result(0);
+
+    usb_write(results, count * sizeof(Result));
+
+    free(results);
+}
+
+void pack_file(FsFileSystem *fs, const char *path) {
+    struct {
+        Result rc;
+        u32 pad;
+        s64 size;
+    } header = {0};
+
+    FsFile file;
+    header.rc = fsFsOpenFile(fs, path, FsOpenMode_Read, &file);
+    if (R_SUCCEEDED(header.rc)) {
+        header.rc = fsFileGetSize(&file, &header.size);
+
+        if (R_FAILED(header.rc)) {
+            fsFileClose(&file);
+        }
+    }
+
+    usb_write(&header, sizeof(header));
+
+    if (R_FAILED(header.rc)) {
+        return;
+    }
+
+    // The announced size always gets sent, anything that couldn't be read is zeroed
+    Result rc = 0;
+    for (s64 offset = 0; offset < header.size; ) {
+        u64 to_read = (header.size - offset > PACK_BUFFER_SIZE) ? PACK_BUFFER_SIZE : header.size - offset;
+
+        u64 bytes_read = 0;
+        if (R_SUCCEEDED(rc)) {
+            rc = fsFileRead(&file, offset, pack_buffer, to_read, FsReadOption_None, &bytes_read);
+            if (R_FAILED(rc)) {
+                bytes_read = 0;
+            }
+        }
+
+        if (bytes_read < to_read) {
+            memset(pack_buffer + bytes_read, 0, to_read - bytes_read);
+        }
+
+        usb_write(pack_buffer, to_read);
+
+        offset += to_read;
+    }
+
+    fsFileClose(&file);
+
+    write_result(rc);
+}
+
+void PackFiles() {
+    PRINTF("PackFiles\n");
+
+    FsFileSystem fs;
+    usb_read(&fs.s, sizeof(fs.s));
+
+    struct {
+        u32 count;
+        u32 paths_size;
+    } info;
+    usb_read(&info, sizeof(info));
+
+    // The host never sends more than PACK_PATHS_SIZE at once
+    if (info.paths_size > PACK_PATHS_SIZE) {
+        write_result(MAKERESULT(NXIPC_MODULE, 5));
+
+        return;
+    }
+
+    usb_read(pack_paths, info.paths_size);
+    pack_paths[info.paths_size] = '\0';
+
+    write_result(0);
+
+    char *path = pack_paths;
+    for (u32 i = 0; i < info.count; i++) {
+        if (path >= pack_paths + info.paths_size) {
+            struct {
+                Result rc;
+                u32 pad;
+                s64 size;
+            } header = { .rc = MAKERESULT(NXIPC_MODULE, 5) };
+
+            usb_write(&header, sizeof(header));
+
+            continue;
+        }
+
+        pack_file(&fs, path);
+
+        path += strlen(path) + 1;
+    }
+}
+
+void Ping() {
+    PRINTF("Ping\n");
+
+    struct {
+        u64 magic;
+        u64 nonce;
+    } pong;
+
+    usb_read(&pong.nonce, sizeof(pong.nonce));
+    pong.magic = PING_MAGIC;
+
+    usb_write(&pong, sizeof(pong));
+}
+
+void GetDeviceInfo() {
+    PRINTF("GetDeviceInfo\n");
+
+    // Our __appInit doesn't set up hosversion, so ask set:sys the first time
+    static u32 hos_version = 0;
+
+    if (hos_version == 0) {
+        Result rc = setsysInitialize();
+        if (R_FAILED(rc)) {
+            write_result(rc);
+            return;
+        }
+
+        SetSysFirmwareVersion fw;
+        rc = setsysGetFirmwareVersion(&fw);
+        setsysExit();
+
+        if (R_FAILED(rc)) {
+            write_result(rc);
+            return;
+        }
+
+        hos_version = MAKEHOSVERSION(fw.major, fw.minor, fw.micro);
+    }
+
+    struct {
+        u32 hos_version;
+        u32 protocol_version;
+        u64 capabilities;
+    } info = { hos_version, PROTOCOL_VERSION, CAPABILITIES };
+
+    write_result(0);
+    usb_write(&info, sizeof(info));
+}
+
+void EnableChannels();
+
+bool handle_command(u8 cmd_id) {
+    bool should_break = false;
+
+    switch(cmd_id) {
+        case CommandId_Exit:
+            write_result(0);
+
+            should_break = true;
+
+            break;
+
+        case CommandId_Allocate:
+            Allocate();
+            break;
+
+        case CommandId_Free:
+            Free();
+            break;
+
+        case CommandId_Read:
+            Read();
+            break;
+
+        case CommandId_Write:
+            Write();
+            break;
+
+        case CommandId_GetService:
+            GetService();
+            break;
+
+        case CommandId_CloseService:
+            CloseService();
+            break;
+
+        case CommandId_ConvertServiceToDomain:
+            ConverServiceToDomain();
+            break;
+
+        case CommandId_DispatchToService:
+            DispatchToService();
+            break;
+
+        case CommandId_WalkTree:
+            WalkTree();
+            break;
+
+        case CommandId_UnpackFiles:
+            mutexLock(&pack_mutex);
+            UnpackFiles();
+            mutexUnlock(&pack_mutex);
+            break;
+
+        case CommandId_PackFiles:
+            mutexLock(&pack_mutex);
+            PackFiles();
+            mutexUnlock(&pack_mutex);
+            break;
+
+        case CommandId_Nop:
+            break;
+
+        case CommandId_Ping:
+            Ping();
+            break;
 
-            default:
-                PRINTF("Invalid command\n");
+        case CommandId_EnableChannels:
+            // Channels can't be nested
+            if (current_channel != NULL) {
                 write_result(MAKERESULT(NXIPC_MODULE, 2));
+            } else {
+                EnableChannels();
+            }
 
-                break;
+            break;
+
+        case CommandId_GetDeviceInfo:
+            GetDeviceInfo();
+            break;
+
+        default:
+            PRINTF("Invalid command\n");
+            write_result(MAKERESULT(NXIPC_MODULE, 2));
+
+            break;
+    }
+
+
+    return should_break;
+}
+
+void mux_worker(void *arg) {
+    current_channel = (MuxChannel *) arg;
+
+    while (true) {
+        u8 cmd_id;
+        usb_read(&cmd_id, sizeof(cmd_id));
+
+        mutexLock(&current_channel->mutex);
+        bool closed = current_channel->closed && current_channel->head == NULL;
+        mutexUnlock(&current_channel->mutex);
+
+        if (closed || handle_command(cmd_id)) {
+            break;
+        }
+    }
+}
+
+void mux_close_channels(u32 count) {
+    for (u32 i = 0; i < count; i++) {
+        MuxChannel *ch = &mux_channels[i];
+
+        mutexLock(&ch->mutex);
+        ch->closed = true;
+        condvarWakeAll(&ch->cond);
+        mutexUnlock(&ch->mutex);
+    }
+
+    for (u32 i = 0; i < count; i++) {
+        MuxChannel *ch = &mux_channels[i];
+
+        threadWaitForExit(&ch->thread);
+        threadClose(&ch->thread);
+
+        while (ch->head != NULL) {
+            MuxFrame *next = ch->head->next;
+            free(ch->head);
+            ch->head = next;
+        }
+
+        ch->tail = NULL;
+    }
+}
+
+void mux_drain(u32 size) {
+    u8 tmp[MAX_READ_WRITE];
+
+    for (u32 tmp_size = 0; tmp_size < size; tmp_size += MAX_READ_WRITE) {
+        u32 to_read;
+        if (size - tmp_size > MAX_READ_WRITE) {
+            to_read = MAX_READ_WRITE;
+        } else {
+            to_read = size - tmp_size;
+        }
+
+        raw_usb_read(tmp, to_read);
+    }
+}
+
+void EnableChannels() {
+    PRINTF("EnableChannels\n");
+
+    u32 count;
+    usb_read(&count, sizeof(count));
+
+    if (count == 0 || count > MUX_MAX_CHANNELS) {
+        write_result(MAKERESULT(NXIPC_MODULE, 6));
+
+        return;
+    }
+
+    mutexInit(&mux_write_mutex);
+
+    for (u32 i = 0; i < count; i++) {
+        MuxChannel *ch = &mux_channels[i];
+        memset(ch, 0, sizeof(*ch));
+
+        ch->id = i;
+        mutexInit(&ch->mutex);
+        condvarInit(&ch->cond);
+
+        Result rc = threadCreate(&ch->thread, mux_worker, ch, NULL, MUX_STACK_SIZE, MUX_THREAD_PRIORITY, -2);
+        if (R_SUCCEEDED(rc)) {
+            rc = threadStart(&ch->thread);
+
+            if (R_FAILED(rc)) {
+                threadClose(&ch->thread);
+            }
+        }
+
+        if (R_FAILED(rc)) {
+            mux_close_channels(i);
+            write_result(rc);
+
+            return;
+        }
+    }
+
+    write_result(0);
+
+    // Route incoming frames to their channels until the host sends a control frame
+    while (true) {
+        MuxHeader header;
+        raw_usb_read(&header, sizeof(header));
+
+        if (header.channel == MUX_CONTROL_CHANNEL) {
+            break;
+        }
+
+        MuxFrame *frame = NULL;
+        if (header.channel < count) {
+            frame = malloc(sizeof(MuxFrame) + header.size);
         }
 
+        if (frame == NULL) {
+            mux_drain(header.size);
+
+            continue;
+        }
+
+        raw_usb_read(frame->data, header.size);
+
+        frame->next = NULL;
+        frame->size = header.size;
+        frame->pos  = 0;
+
+        MuxChannel *ch = &mux_channels[header.channel];
+
+        mutexLock(&ch->mutex);
+
+        if (ch->tail == NULL) {
+            ch->head = frame;
+        } else {
+            ch->tail->next = frame;
+        }
+
+        ch->tail = frame;
+
+        condvarWakeAll(&ch->cond);
+        mutexUnlock(&ch->mutex);
+    }
+
+    mux_close_channels(count);
+
+    MuxHeader ack = {
+        .channel = MUX_CONTROL_CHANNEL,
+        .size    = 0,
+    };
+    raw_usb_write(&ack, sizeof(ack));
+}
+
+int main(int argc, char **argv) {
+    #ifdef DEBUG
+
+    consoleInit(NULL);
+
+    #endif
+
+    usbCommsInitialize();
+
+    while (appletMainLoop()) {
+        PRINTF("loop\n");
+        u8 cmd_id;
+        usb_read(&cmd_id, sizeof(cmd_id));
+        PRINTF("%d\n", cmd_id);
+
+        bool should_break = handle_command(cmd_id);
+
         if (should_break)
             break;
     }
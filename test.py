@@ -2,9 +2,7 @@
 
 import nxipc
 
-import math
 import audioread
-from ctypes import *
 
 def do_acc_stuff(h):
     acc = nxipc.services.Account(h)
@@ -24,37 +22,13 @@ def do_audout_stuff(h):
     with audioread.audio_open("test2.flac") as f:
         audio_out, name, out = audout.open_audio_out()
         print(out.sample_rate, out.channel_count, name)
-        input()
-
-        data_size = out.sample_rate * out.channel_count * sizeof(c_int16) * f.duration
-        data_size = math.ceil(data_size)
-
-        buffer_size = nxipc.util.align(data_size, 0x1000)
-
-        data = audout.allocate("memalign", buffer_size, 0x1000)
 
         f.channels = out.channel_count
         f.samplerate = out.sample_rate
 
-        offset = 0
-        for buf in f:
-            audout.write(c_void_p(data.value + offset), buf)
-            offset += len(buf)
-
-    print(hex(data.value), hex(data_size), hex(buffer_size))
-
-    buffer = audout.Buffer(
-        buffer=data,
-        buffer_size=buffer_size,
-        data_size=data_size
-    )
-
-    audio_out.start()
-    audio_out.append_buffer(buffer)
-
-    input()
-    audio_out.stop()
-    audout.free(data)
+        # Only a few small buffers live on the console, refilled as they're played
+        with audio_out.stream(f) as stream:
+            stream.wait()
 
 def do_fs_stuff(h):
     fs = nxipc.services.FspSrv(h)
@@ -70,10 +44,11 @@ def do_fs_stuff(h):
     fs.close()
 
 def main():
-    h = nxipc.UsbCommandHandler()
+    h = nxipc.UsbCommandHandler(device_cache=nxipc.cache.DeviceCache())
 
-    with nxipc.services.SetSys(h) as setsys:
-        nxipc.Service.set_hos_version(setsys)
+    # Only goes through set:sys when the console's firmware changed since last time
+    h.load_firmware_version()
+    print(h.startup_stats)
 
     do_fs_stuff(h)
     do_acc_stuff(h)